@@ -3,11 +3,26 @@
 
 import pandas as pd
 import requests
-from jinja2 import Environment, FileSystemLoader
+import csv
+import time
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from urllib3.exceptions import NewConnectionError
 import argparse
 import json
 import logging
+import math
 import configparser
+import os
+import sys
+import threading
+from queue import Queue
+
+# dnscache.py, workers.py and zabbix_client.py are shared with the zabbix-snow scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zabbix-snow'))
+from dnscache import DNSCache
+from zabbix_client import ZabbixClient
+import workers
+
 config = configparser.ConfigParser()
 config.read('config.ini')
 # Create "config.ini" see example in "config.ini.example"
@@ -20,12 +35,33 @@ logger = logging.getLogger(__name__)
 parser = argparse.ArgumentParser(description="Process CSV to generate Zabbix API requests.")
 parser.add_argument('--csv', required=True, help='Path to the CSV file to be processed.')
 parser.add_argument('--test', action='store_true', help='Print JSON payloads without making API requests.')
+parser.add_argument('--check-dns', action='store_true', help='Warn when a host name does not resolve to its ip_address.')
+parser.add_argument('--dns-cache', default='dns_cache.json', help='File used to cache DNS answers between runs.')
+parser.add_argument('--chunk-size', type=int, default=0, help='Stream the CSV in chunks of this many rows instead of loading it whole.')
+parser.add_argument('--workers', type=int, default=8, help='Number of API requests sent in parallel.')
+parser.add_argument('--rate', type=float, default=20, help='Max API requests started per second, 0 for no limit.')
+parser.add_argument('--retries', type=int, default=3, help='Retries for a request that was not accepted (connect failure, HTTP 429/503), or for a host.update whose outcome is unknown.')
+parser.add_argument('--backoff', type=float, default=1.0, help='Seconds to wait before the first retry, doubled on each further retry.')
+parser.add_argument('--results', help='CSV file recording the API result or error of every row (default results.csv, or results-test.csv with --test).')
+parser.add_argument('--fast-payloads', action='store_true', help='Build payloads directly instead of rendering the Jinja2 templates.')
+parser.add_argument('--verify-payloads', action='store_true', help='With --fast-payloads, also render each template and check both payloads are identical.')
 args = parser.parse_args()
 
-def load_csv(file_path):
-    """Load the CSV file into a DataFrame, with error handling for file issues."""
+# Column types: numeric columns with their default, JSON columns, and
+# columns kept as plain text (so e.g. a numeric community stays a string)
+NUMERIC_COLUMNS = {'group_id': 0, 'template_id': 0, 'version': 3, 'bulk': 0, 'securitylevel': 1, 'inventory_mode': 0}
+JSON_COLUMNS = {'tags': [], 'macros': [], 'inventory': {}}
+TEXT_COLUMNS = ['action', 'host_name', 'ip_address', 'host_type', 'encrypted_value',
+                'snmp_community', 'securityname', 'contextname']
+
+def load_csv(file_path, chunk_size=None):
+    """Load the CSV file into a DataFrame, with error handling for file issues.
+
+    With a chunk_size, return an iterator of DataFrames of at most that
+    many rows instead, so the file is never held in memory whole.
+    """
     try:
-        return pd.read_csv(file_path, on_bad_lines='skip')
+        return pd.read_csv(file_path, on_bad_lines='skip', dtype={column: str for column in TEXT_COLUMNS}, chunksize=chunk_size)
     except FileNotFoundError:
         logger.error(f"File not found: {file_path}")
         raise
@@ -36,13 +72,18 @@ def load_csv(file_path):
         logger.error(f"Error parsing the file: {file_path}")
         raise
 
-# Load CSV file
-csv_file = args.csv
-df = load_csv(csv_file)
-
-# Set up Jinja2 environment
+# Set up Jinja2 environment; compiled templates are cached on disk between runs
 file_loader = FileSystemLoader('./templates')
-env = Environment(loader=file_loader)
+env = Environment(loader=file_loader, bytecode_cache=FileSystemBytecodeCache())
+
+TEMPLATE_FILES = [
+    'zabbix_template_snmp.jinja2',
+    'zabbix_template_encrypted.jinja2',
+    'zabbix_template_unencrypted.jinja2',
+    'zabbix_template_delete.jinja2',
+    'zabbix_template_update.jinja2'
+]
+templates = {template_file: env.get_template(template_file) for template_file in TEMPLATE_FILES}
 
 # Zabbix API details
 zabbix_url = config.get('zabbix', 'url')
@@ -60,14 +101,175 @@ def parse_json_field(field_value):
         logger.error("JSONDecodeError: %s for field: %s", e, field_value)
         return {}
 
-def process_row(row, test_mode=False):
-    """Process each row to generate JSON payloads and make API requests."""
-    logger.info("Processing row with host_name: %s", row.get('host_name', 'Unknown'))
+def parse_json_column(values):
+    """Parse each distinct value of a JSON column once; empty cells become {}."""
+    present = values.notna()
+    parsed = {value: parse_json_field(value) for value in values[present].unique()}
+    return [parsed[value] if is_present else {} for value, is_present in zip(values, present)]
 
-    action = row.get('action')
-    if not action:
-        logger.warning("No action specified for row with host_name: %s", row.get('host_name', 'Unknown'))
+def prepare_records(df):
+    """Coerce all columns in bulk and return one ready-to-render dict per row."""
+    prepared = pd.DataFrame(index=df.index)
+    for column in TEXT_COLUMNS:
+        prepared[column] = df[column].fillna('') if column in df else ''
+    for column, default in NUMERIC_COLUMNS.items():
+        if column in df:
+            prepared[column] = pd.to_numeric(df[column], errors='coerce').fillna(default).astype('int64')
+        else:
+            prepared[column] = default
+    for column, default in JSON_COLUMNS.items():
+        prepared[column] = parse_json_column(df[column]) if column in df else [default] * len(df)
+
+    # host_id is only required for delete/modify rows, so missing stays None.
+    # Numbers are truncated like int(float(x)); anything else is kept as text
+    # so process_row can skip that row with a warning
+    raw_ids = df['host_id'] if 'host_id' in df else pd.Series(None, index=df.index, dtype=object)
+    numeric_ids = pd.to_numeric(raw_ids, errors='coerce')
+    # object dtype, or pandas turns a mix of ints and None into float64
+    prepared['host_id'] = pd.Series([
+        None if pd.isna(raw) else int(number) if math.isfinite(number) else str(raw)
+        for raw, number in zip(raw_ids, numeric_ids)
+    ], index=df.index, dtype=object)
+
+    # Data row number in the CSV (1 = first row after the header)
+    prepared['row'] = df.index + 1
+
+    return prepared.to_dict('records')
+
+def _create_params(data):
+    # Fields shared by the three host.create templates, in template order
+    return {
+        "host": str(data['host_name']),
+        "status": 1,
+        "interfaces": [
+            {
+                "type": 2,
+                "main": 1,
+                "useip": 1,
+                "ip": str(data['ip_address']),
+                "dns": "",
+                "port": "161"
+            }
+        ],
+        "groups": [{"groupid": str(data['group_id'])}],
+        "templates": [{"templateid": str(data['template_id'])}]
+    }
+
+def _request(method, params, data):
+    return {"jsonrpc": "2.0", "method": method, "params": params, "auth": str(data['auth_token']), "id": 1}
+
+def build_snmp_payload(data):
+    params = _create_params(data)
+    params['interfaces'][0]['details'] = {
+        "version": str(data['version']),
+        "bulk": str(data['bulk']),
+        "securityname": str(data['securityname']),
+        "contextname": str(data['contextname']),
+        "securitylevel": str(data['securitylevel'])
+    }
+    return _request("host.create", params, data)
+
+def build_encrypted_payload(data):
+    params = _create_params(data)
+    if data['encrypted_value']:
+        params['macros'] = [{"macro": "{$ENCRYPTED_MACRO}", "value": str(data['encrypted_value'])}]
+    return _request("host.create", params, data)
+
+def build_unencrypted_payload(data):
+    params = _create_params(data)
+    if data['tags']:
+        params['tags'] = data['tags']
+    if data['macros']:
+        params['macros'] = data['macros']
+    params['inventory_mode'] = int(data['inventory_mode'])
+    if data['inventory']:
+        params['inventory'] = data['inventory']
+    return _request("host.create", params, data)
+
+def build_delete_payload(data):
+    return _request("host.delete", [str(data['host_id'])], data)
+
+def build_update_payload(data):
+    params = {
+        "hostid": str(data['host_id']),
+        "host": str(data['host_name']),
+        "groups": [{"groupid": str(int(data['group_id']))}],
+        "templates": [{"templateid": str(data['template_id'])}]
+    }
+    return _request("host.update", params, data)
+
+# Direct builders producing the same payload as each template renders to
+PAYLOAD_BUILDERS = {
+    'zabbix_template_snmp.jinja2': build_snmp_payload,
+    'zabbix_template_encrypted.jinja2': build_encrypted_payload,
+    'zabbix_template_unencrypted.jinja2': build_unencrypted_payload,
+    'zabbix_template_delete.jinja2': build_delete_payload,
+    'zabbix_template_update.jinja2': build_update_payload
+}
+
+def render_payload(template_file, data):
+    """Return the request payload for template_file as a dict."""
+    if not args.fast_payloads:
+        return json.loads(templates[template_file].render(data))
+
+    payload = PAYLOAD_BUILDERS[template_file](data)
+    if args.verify_payloads:
+        rendered = json.loads(templates[template_file].render(data))
+        if json.dumps(payload) != json.dumps(rendered):
+            logger.error("Direct payload differs from %s for host '%s', using the rendered one", template_file, data.get('host_name', data.get('host_id')))
+            return rendered
+    return payload
+
+def prefetch_records(chunks):
+    """Yield prepare_records() of each chunk, preparing the next one in a background thread.
+
+    At most one prepared chunk waits in the queue, so memory stays bounded
+    by a few chunks whatever the size of the file.
+    """
+    queue = Queue(maxsize=1)
+    done = object()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                queue.put(prepare_records(chunk))
+        except Exception as e:
+            queue.put(e)
+        else:
+            queue.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def check_dns(row, dns_cache):
+    """Warn if host_name does not resolve, or resolves to something other than ip_address."""
+    host_name = row.get('host_name')
+    ip_address = row.get('ip_address')
+    if not isinstance(host_name, str) or not host_name:
         return
+    addresses = dns_cache.resolve(host_name)
+    if not addresses:
+        logger.warning("Host name '%s' does not resolve", host_name)
+    elif isinstance(ip_address, str) and ip_address and ip_address not in addresses:
+        logger.warning("Host name '%s' resolves to %s, not %s", host_name, ', '.join(addresses), ip_address)
+
+def process_row(row):
+    """Generate the JSON payload for a prepared record.
+
+    Returns (payload, None), or (None, reason) when the row is skipped.
+    """
+    logger.info("Processing row with host_name: %s", row['host_name'] or 'Unknown')
+
+    action = row['action']
+    if not action:
+        logger.warning("No action specified for row with host_name: %s", row['host_name'] or 'Unknown')
+        return None, "No action specified"
 
     # Initialize data dictionary
     data = {
@@ -77,98 +279,212 @@ def process_row(row, test_mode=False):
     template_file = None
     
     if action == 'c':
-        host_type = row.get('host_type', 'default')
+        host_type = row['host_type'] or 'default'
         if host_type == 'snmp':
             template_file = 'zabbix_template_snmp.jinja2'
             data.update({
-                "host_name": row.get('host_name', ''),
-                "ip_address": row.get('ip_address', ''),
-                "group_id": int(float(row.get('group_id', '0'))),
-                "template_id": int(float(row.get('template_id', '0'))),
-                "snmp_community": row.get('snmp_community', ''),
-                "version": int(float(row.get('version', 3))) if pd.notna(row.get('version')) else 3,
-                "bulk": int(float(row.get('bulk', 0))) if pd.notna(row.get('bulk')) else 0,
-                "securityname": row.get('securityname', ''),
-                "contextname": row.get('contextname', ''),
-                "securitylevel": int(float(row.get('securitylevel', 1))) if pd.notna(row.get('securitylevel')) else 1
+                "host_name": row['host_name'],
+                "ip_address": row['ip_address'],
+                "group_id": row['group_id'],
+                "template_id": row['template_id'],
+                "snmp_community": row['snmp_community'],
+                "version": row['version'],
+                "bulk": row['bulk'],
+                "securityname": row['securityname'],
+                "contextname": row['contextname'],
+                "securitylevel": row['securitylevel']
             })
         elif host_type == 'encrypted':
             template_file = 'zabbix_template_encrypted.jinja2'
             data.update({
-                "host_name": row.get('host_name', ''),
-                "ip_address": row.get('ip_address', ''),
-                "group_id": int(float(row.get('group_id', '0'))),
-                "template_id": int(float(row.get('template_id', '0'))),
-                "encrypted_value": row.get('encrypted_value', ''),
-                "macros": parse_json_field(row.get('macros', '[]'))
+                "host_name": row['host_name'],
+                "ip_address": row['ip_address'],
+                "group_id": row['group_id'],
+                "template_id": row['template_id'],
+                "encrypted_value": row['encrypted_value'],
+                "macros": row['macros']
             })
         else:
             template_file = 'zabbix_template_unencrypted.jinja2'
             data.update({
-                "host_name": row.get('host_name', ''),
-                "ip_address": row.get('ip_address', ''),
-                "group_id": int(float(row.get('group_id', '0'))),
-                "template_id": int(float(row.get('template_id', '0'))),
-                "tags": parse_json_field(row.get('tags', '[]')),
-                "macros": parse_json_field(row.get('macros', '[]')),
-                "inventory_mode": int(float(row.get('inventory_mode', 0))) if pd.notna(row.get('inventory_mode')) else 0,
-                "inventory": parse_json_field(row.get('inventory', '{}'))
+                "host_name": row['host_name'],
+                "ip_address": row['ip_address'],
+                "group_id": row['group_id'],
+                "template_id": row['template_id'],
+                "tags": row['tags'],
+                "macros": row['macros'],
+                "inventory_mode": row['inventory_mode'],
+                "inventory": row['inventory']
             })
     elif action == 'd':
         template_file = 'zabbix_template_delete.jinja2'
-        host_id = row.get('host_id')
-        if not host_id:
-            logger.warning("Host ID is required for delete action. Skipping host '%s'.", row.get('host_name'))
-            return
-        try:
-            data["host_id"] = int(float(host_id))  # Convert to integer
-        except ValueError:
-            logger.warning("Invalid Host ID '%s' for delete action. Skipping host '%s'.", host_id, row.get('host_name'))
-            return
+        if row['host_id'] is None:
+            logger.warning("Host ID is required for delete action. Skipping host '%s'.", row['host_name'])
+            return None, "Host ID is required for delete action"
+        if isinstance(row['host_id'], str):
+            logger.warning("Invalid Host ID '%s' for delete action. Skipping host '%s'.", row['host_id'], row['host_name'])
+            return None, f"Invalid Host ID '{row['host_id']}'"
+        data["host_id"] = row['host_id']
     elif action == 'm':
         template_file = 'zabbix_template_update.jinja2'
+        if isinstance(row['host_id'], str):
+            logger.warning("Invalid Host ID '%s' for modify action. Skipping host '%s'.", row['host_id'], row['host_name'])
+            return None, f"Invalid Host ID '{row['host_id']}'"
         data.update({
-            "host_name": row.get('host_name', ''),
-            "ip_address": row.get('ip_address', ''),
-            "group_id": int(float(row.get('group_id', '0'))),
-            "template_id": int(float(row.get('template_id', '0'))),
-            "host_id": int(float(row.get('host_id', '0'))),
-            "snmp_community": row.get('snmp_community', ''),
-            "tags": parse_json_field(row.get('tags', '[]')),
-            "macros": parse_json_field(row.get('macros', '[]')),
-            "inventory_mode": int(float(row.get('inventory_mode', 0))) if pd.notna(row.get('inventory_mode')) else 0,
-            "inventory": parse_json_field(row.get('inventory', '{}'))
+            "host_name": row['host_name'],
+            "ip_address": row['ip_address'],
+            "group_id": row['group_id'],
+            "template_id": row['template_id'],
+            "host_id": row['host_id'] if row['host_id'] is not None else 0,
+            "snmp_community": row['snmp_community'],
+            "tags": row['tags'],
+            "macros": row['macros'],
+            "inventory_mode": row['inventory_mode'],
+            "inventory": row['inventory']
         })
     else:
-        logger.warning("Unknown action '%s' for host '%s'", action, row.get('host_name', 'Unknown'))
-        return
+        logger.warning("Unknown action '%s' for host '%s'", action, row['host_name'] or 'Unknown')
+        return None, f"Unknown action '{action}'"
 
-    # Render JSON payload
+    # Build JSON payload
     try:
-        if template_file:
-            template = env.get_template(template_file)
-            json_payload = template.render(data)
-
-            # Convert JSON payload to Python dict for validation
-            json_payload_dict = json.loads(json_payload)
-            
-            # Print JSON payload in test mode or make request
-            if test_mode:
-                logger.info("Formatted JSON payload for test mode:")
-                logger.info(json.dumps(json_payload_dict, indent=4))
-            else:
-                headers = {'Content-Type': 'application/json'}
-                response = requests.post(zabbix_url, headers=headers, data=json.dumps(json_payload_dict))
-                logger.info("API response: %s", response.json())
+        return render_payload(template_file, data), None
+    except Exception as e:
+        logger.error("Error rendering template: %s", e)
+        return None, f"Error rendering template: {e}"
+
+# HTTP statuses meaning the request was turned away without being applied
+REJECTED_STATUS = {429, 503}
+# Other server errors, timeouts and dropped connections leave it unknown
+# whether Zabbix applied the request, so only idempotent methods resend then
+IDEMPOTENT_METHODS = {'host.update'}
+
+def _not_sent(error):
+    """True if the request failed before it reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
 
-            print("\n")
+def post_payload(zabbix, payload):
+    """POST payload to the Zabbix API, retrying with exponential backoff.
+
+    Requests that were never sent or were rejected are always retried. When
+    the outcome is unknown, host.create and host.delete are not resent
+    (a retry would fail with "already exists" or "no permissions" if the
+    first attempt was applied); the row is recorded as "Outcome unknown".
+    """
+    method = payload['method']
+    for attempt in range(args.retries + 1):
+        try:
+            data = zabbix.post(payload)
+            break
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code < 500 and e.response.status_code not in REJECTED_STATUS:
+                raise
+            error = e
+            ambiguous = e.response.status_code not in REJECTED_STATUS
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+            ambiguous = not _not_sent(e)
+        if ambiguous and method not in IDEMPOTENT_METHODS:
+            raise Exception(f"Outcome unknown, check the host in Zabbix before resending: {error}")
+        if attempt == args.retries:
+            raise Exception(f"Giving up after {attempt + 1} attempts: {error}")
+        delay = args.backoff * 2 ** attempt
+        logger.warning("%s failed (%s), retrying in %.1fs", method, error, delay)
+        time.sleep(delay)
+
+    logger.info("API response: %s", data)
+    if 'error' in data:
+        raise Exception(f"{method} failed: {data['error']}")
+    return data['result']
+
+def dry_run(payload):
+    """Test mode stand-in for post_payload: log the payload instead of sending it."""
+    logger.info("Formatted JSON payload for test mode:")
+    logger.info(json.dumps(payload, indent=4))
+    print("\n")
+
+def submit_records(records, submit, pool_workers, rate):
+    """Build and submit the payloads of one chunk of records.
+
+    Rows for the same host keep their CSV order, different hosts are sent in
+    parallel on up to pool_workers threads. Returns one result dict per
+    record for the results file.
+    """
+    outcomes = []
+    tasks = []
+    for row in records:
+        if dns_cache and row['action'] in ('c', 'm'):
+            check_dns(row, dns_cache)
+        payload, error = process_row(row)
+        outcome = {'row': row['row'], 'action': row['action'], 'host_name': row['host_name'], 'host_id': row['host_id']}
+        if payload is None:
+            outcome.update({'ok': False, 'error': error})
         else:
-            logger.error("Template file not found for action '%s'", action)
-    except Exception as e:
-        logger.error("Error rendering template or making request: %s", e)
+            # A host is identified by host_id wherever the row has one, so a
+            # delete and an update of the same host never run concurrently
+            if row['host_id'] is not None:
+                key = ('host_id', row['host_id'])
+            else:
+                key = ('host_name', row['host_name'])
+            tasks.append((key, f"{payload['method']} of host {key[1]}", submit, (payload,)))
+        outcomes.append(outcome)
+
+    results = iter(workers.run_keyed(tasks, workers=pool_workers, rate=rate))
+    for outcome in outcomes:
+        if 'ok' not in outcome:
+            result = next(results)
+            outcome['ok'] = result['ok']
+            if result['ok']:
+                # Dry runs have no API result to record
+                outcome['result'] = json.dumps(result['result']) if result['result'] is not None else ''
+            else:
+                outcome['error'] = result['error']
+    return outcomes
+
+dns_cache = DNSCache(args.dns_cache) if args.check_dns else None
+
+# Load CSV file, whole or as a stream of chunks
+csv_file = args.csv
+if args.chunk_size > 0:
+    chunks = load_csv(csv_file, args.chunk_size)
+else:
+    chunks = [load_csv(csv_file)]
+
+# In test mode the same pipeline runs, but payloads are only logged, in
+# CSV order and without rate limiting, and results go to their own file
+if args.test:
+    zabbix = None
+    submit = dry_run
+    pool_workers, rate = 1, None
+    results_path = args.results or 'results-test.csv'
+else:
+    zabbix = ZabbixClient(zabbix_url, auth_token, pool_size=max(1, args.workers))
+    submit = lambda payload: post_payload(zabbix, payload)
+    pool_workers, rate = args.workers, args.rate or None
+    results_path = args.results or 'results.csv'
+
+# Process each prepared record, writing every row's outcome as it completes
+rows_done = 0
+succeeded = 0
+with open(results_path, mode='w', newline='') as results_file:
+    writer = csv.DictWriter(results_file, fieldnames=['row', 'action', 'host_name', 'host_id', 'ok', 'result', 'error'])
+    writer.writeheader()
+    for chunk_number, records in enumerate(prefetch_records(chunks), start=1):
+        outcomes = submit_records(records, submit, pool_workers, rate)
+        writer.writerows(outcomes)
+        results_file.flush()
+        rows_done += len(outcomes)
+        succeeded += sum(1 for outcome in outcomes if outcome['ok'])
+        if args.chunk_size > 0:
+            logger.info("Chunk %d done: %d rows (%d rows total)", chunk_number, len(records), rows_done)
 
-# Process each row in the DataFrame
-for _, row in df.iterrows():
-    process_row(row, test_mode=args.test)
+if zabbix:
+    zabbix.close()
+if dns_cache:
+    dns_cache.save()
 
-logger.info("Process completed.")
+logger.info("Process completed: %d rows, %d succeeded, %d failed or skipped. Results in %s",
+            rows_done, succeeded, rows_done - succeeded, results_path)
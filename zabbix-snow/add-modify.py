@@ -2,38 +2,71 @@
 # Aug 29, 2024
 
 import requests
+import argparse
+import itertools
 import json
 import logging
-import creds
 import os
+from collections import defaultdict
+import creds
+import probes
+import workers
+from dnscache import DNSCache
+from snow_client import ServiceNowClient
+from zabbix_client import ZabbixClient
 
 # Configure logging
 logging.basicConfig(filename='audit_log.txt', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-snow_url = "https://dev.service-now.com/api/now/table/x_noann_add_drop_m_add_drop_modify?sysparm_query=opened_atONLast%207%20days%40javascript%3Ags.beginningOfToday()%40javascript%3Ags.endOfToday()^state=3"
+snow_instance = "https://dev.service-now.com"
+snow_table = "x_noann_add_drop_m_add_drop_modify"
+snow_query = "opened_atONLast 7 days@javascript:gs.beginningOfToday()@javascript:gs.endOfToday()^state=3"
+snow_fields = [
+    "sys_id", "sys_updated_on", "add_drop_modify", "u_adm_ip_addr", "u_nn_adm_oldfqdn", "u_nn_adm_newip",
+    "u_nn_adm_existingip", "u_nn_adm_zone", "u_nn_adm_hostname", "u_nn_adm_newhostname"
+]
+snow = ServiceNowClient(snow_instance, auth=(creds.snow_username, creds.snow_password))
+
+# Newest (sys_updated_on, sys_id) processed by the last successful run
+sync_state_file = 'snow_sync_state.json'
+
+# HostIndex snapshot answering host lookups locally (--snapshot), else None
+host_index = None
+
+# Zabbix host writes run inline, or with --workers > 1 are queued and
+# applied by a bounded worker pool once all records have been processed
+write_workers = 1
+write_rate = None  # Max write calls per second, None for no limit
+pending_writes = []
+pending_cursors = []  # (sys_updated_on, sys_id) of the record behind each pending write
+# Hosts as they will be once the queued writes are applied, so later records
+# of the same run see queued creates and updates (a HostIndex with --workers > 1).
+# Queued creates get negative placeholder hostids until the create has run.
+pending_hosts = None
+placeholder_ids = itertools.count(1)
+created_hostids = {}  # placeholder hostid -> hostid returned by host.create
 
 # Zabbix API credentials
 zabbix_url = 'https://zabbix.example.net/api_jsonrpc.php'
+zabbix = ZabbixClient(zabbix_url, creds.auth_token)
+
+# DNS/reachability probes run concurrently before records are processed.
+# probe_method is 'icmp' (one ping) or 'tcp' (connect to probe_tcp_port)
+probe_concurrency = 50
+probe_timeout = 2
+probe_method = 'icmp'
+probe_tcp_port = 22
+# DNS answers are reused across runs until their TTL runs out
+dns_cache = DNSCache('dns_cache.json')
 
 def zabbix_host_get(search_params):
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "host.get",
-        "params": {
+    try:
+        response_data = zabbix.call("host.get", {
             "output": "extend",
             "selectInterfaces": "extend",
             "search": search_params,
             "searchByAny": True,
-        },
-        "auth": creds.auth_token,
-        "id": 1
-    }
-
-    headers = {'content-type': 'application/json'}
-    response = requests.post(zabbix_url, data=json.dumps(payload), headers=headers)
-
-    try:
-        response_data = response.json()
+        })
     except ValueError:
         logging.error("Invalid JSON response received from Zabbix API.")
         return None
@@ -49,36 +82,20 @@ def zabbix_host_get(search_params):
         return None
 
 def zabbix_host_update(host_id, new_data):
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "host.update",
-        "params": {
-            "hostid": host_id,
-            **new_data
-        },
-        "auth": creds.auth_token,
-        "id": 1
-    }
-    headers = {'content-type': 'application/json'}
-    response = requests.post(zabbix_url, data=json.dumps(payload), headers=headers)
-    return response.json()['result']
+    response_data = zabbix.call("host.update", {
+        "hostid": host_id,
+        **new_data
+    })
+    if 'error' in response_data:
+        raise Exception(f"host.update failed: {response_data['error']}")
+    return response_data['result']
 
 def zabbix_host_create(host_data):
     if 'dns' in host_data['interfaces'][0]:
         host_data['interfaces'][0]['dns'] = host_data['interfaces'][0]['dns'].strip()
 
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "host.create",
-        "params": host_data,
-        "auth": creds.auth_token,
-        "id": 1
-    }
-    headers = {'content-type': 'application/json'}
-    response = requests.post(zabbix_url, data=json.dumps(payload), headers=headers)
-    
     try:
-        response_data = response.json()
+        response_data = zabbix.call("host.create", host_data)
     except ValueError:
         logging.error("Invalid JSON response received from Zabbix API when creating host.")
         return None
@@ -102,160 +119,435 @@ def remove_domain_suffix(dns_name):
     
     return dns_name
 
-def process_snow_records():
-    response = requests.get(snow_url, auth=(creds.snow_username, creds.snow_password))
+class HostIndex:
+    """Snapshot of every host's interfaces, keyed by IP and by normalized DNS.
+
+    Lookups are exact matches answered from memory instead of a substring
+    host.get search per record. Hosts created or updated during the run
+    are written back into the index.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.by_ip = defaultdict(set)
+        self.by_dns = defaultdict(set)
+
+    @classmethod
+    def load(cls, zabbix, page_size=5000):
+        index = cls()
+        params = {"output": ["hostid", "host"], "selectInterfaces": ["interfaceid", "ip", "dns", "main"]}
+        for hosts in zabbix.iter_host_pages(params, page_size=page_size):
+            for host in hosts:
+                index.add(host)
+        logging.info(f"INFO - Loaded {len(index.hosts)} hosts into the lookup index.")
+        return index
+
+    @staticmethod
+    def normalize_dns(dns_name):
+        return remove_domain_suffix(dns_name.strip().lower())
+
+    def add(self, host):
+        self.remove(host['hostid'])
+        self.hosts[host['hostid']] = host
+        for interface in host.get('interfaces', []):
+            if interface.get('ip'):
+                self.by_ip[interface['ip']].add(host['hostid'])
+            if interface.get('dns'):
+                self.by_dns[self.normalize_dns(interface['dns'])].add(host['hostid'])
+
+    def remove(self, hostid):
+        host = self.hosts.pop(hostid, None)
+        if host is None:
+            return
+        for interface in host.get('interfaces', []):
+            self.by_ip.get(interface.get('ip'), set()).discard(hostid)
+            self.by_dns.get(self.normalize_dns(interface.get('dns') or ''), set()).discard(hostid)
+
+    def lookup(self, search_params):
+        """Hosts matching any of the ip/dns values, like host.get with searchByAny."""
+        hostids = set()
+        ips = search_params.get('ip', [])
+        for ip in [ips] if isinstance(ips, str) else ips:
+            hostids |= self.by_ip.get(ip.strip(), set())
+        dns_names = search_params.get('dns', [])
+        for dns_name in [dns_names] if isinstance(dns_names, str) else dns_names:
+            hostids |= self.by_dns.get(self.normalize_dns(dns_name), set())
+        return [self.hosts[hostid] for hostid in sorted(hostids, key=int)]
+
+    def update_interface(self, hostid, new_data):
+        host = self.hosts.get(hostid)
+        if host is None or not host.get('interfaces'):
+            return
+        interfaces = [dict(interface) for interface in host['interfaces']]
+        interfaces[0].update({key: new_data[key] for key in ('ip', 'dns') if key in new_data})
+        self.add(dict(host, interfaces=interfaces))
+
+def find_hosts(search_params):
+    if host_index is not None:
+        hosts = host_index.lookup(search_params)
+    else:
+        hosts = zabbix_host_get(search_params)
+    if hosts is None or not pending_hosts or not pending_hosts.hosts:
+        return hosts
+    # Queued writes take precedence over the state from before the run
+    pending = pending_hosts.lookup(search_params)
+    return pending + [host for host in hosts if host['hostid'] not in pending_hosts.hosts]
+
+def update_host(host_id, new_data):
+    # A host created earlier in the same queued run gets its real hostid here
+    host_id = created_hostids.get(host_id, host_id)
+    if int(host_id) < 0:
+        raise Exception("the host.create it depends on failed")
+    result = zabbix_host_update(host_id, new_data)
+    if host_index is not None:
+        host_index.update_interface(host_id, new_data)
+    return result
+
+def create_host(host_data, placeholder=None):
+    result = zabbix_host_create(host_data)
+    if result and placeholder:
+        created_hostids[placeholder] = result['hostids'][0]
+    if result and host_index is not None:
+        for hostid in result.get('hostids', []):
+            host_index.add({'hostid': hostid, 'host': host_data['host'], 'interfaces': host_data['interfaces']})
+    return result
+
+def require_result(fn, *args):
+    result = fn(*args)
+    if not result:
+        raise Exception(f"{fn.__name__} returned no result")
+    return result
+
+def submit_write(cursor, key, description, fn, *args):
+    """Run or queue a Zabbix write for the record at cursor.
+
+    Returns False if an inline write failed, True otherwise.
+    """
+    if write_workers > 1:
+        pending_writes.append((key, description, require_result, (fn, *args)))
+        pending_cursors.append(cursor)
+        return True
+    try:
+        require_result(fn, *args)
+    except Exception as e:
+        logging.error(f"ERROR - {description}: {e}")
+        return False
+    return True
+
+def write_update(cursor, host, new_data):
+    """Update host now, or queue the update and show it to later lookups."""
+    host_id = host['hostid']
+    ok = submit_write(cursor, host_id, f"Update host {host_id}", update_host, host_id, new_data)
+    if pending_hosts is not None:
+        pending_hosts.add(host)
+        pending_hosts.update_interface(host_id, new_data)
+    return ok
+
+def write_create(cursor, host_data):
+    """Create the host now, or queue the create and show it to later lookups.
+
+    Writes are keyed by hostid, so a queued create and later updates of
+    the same host (keyed by its placeholder hostid) run in order.
+    """
+    placeholder = None
+    if pending_hosts is not None:
+        placeholder = str(-next(placeholder_ids))
+        pending_hosts.add({'hostid': placeholder, 'host': host_data['host'], 'interfaces': host_data['interfaces']})
+    return submit_write(cursor, placeholder or host_data['host'], f"Create host {host_data['host']}", create_host, host_data, placeholder)
+
+def apply_pending_writes():
+    """Apply the queued writes and return the cursors of the records whose write failed."""
+    if not pending_writes:
+        return []
+    results = workers.run_keyed(pending_writes, workers=write_workers, rate=write_rate)
+    succeeded, failed = workers.summarize(results)
+    logging.info(f"INFO - Applied {len(results)} Zabbix changes with {write_workers} workers: {succeeded} succeeded, {failed} failed.")
+    failures = []
+    for cursor, result in zip(pending_cursors, results):
+        if not result['ok']:
+            logging.error(f"ERROR - {result['description']}: {result['error']}")
+            failures.append(cursor)
+    pending_writes.clear()
+    pending_cursors.clear()
+    created_hostids.clear()
+    if pending_hosts is not None:
+        for hostid in list(pending_hosts.hosts):
+            pending_hosts.remove(hostid)
+    return failures
+
+def record_probe_target(record):
+    # The (FQDN, IP) pair a record will be checked against, if it has one
+    add_drop_modify = record.get('add_drop_modify')
+    zone = record.get('u_nn_adm_zone')
+    if add_drop_modify == '2':
+        hostname, ip = record.get('u_nn_adm_newhostname'), record.get('u_nn_adm_newip')
+    elif add_drop_modify == '0':
+        hostname, ip = record.get('u_nn_adm_hostname'), record.get('u_adm_ip_addr')
+    else:
+        return None
+
+    if not hostname or not zone or not ip:
+        return None
+    return hostname + zone, ip
+
+def probe_records(records):
+    targets = [target for target in map(record_probe_target, records) if target]
+    logging.info(f"INFO - Probing {len(targets)} DNS names and IPs concurrently.")
+    results = probes.run_probes(
+        [fqdn for fqdn, _ in targets],
+        [ip for _, ip in targets],
+        concurrency=probe_concurrency,
+        timeout=probe_timeout,
+        method=probe_method,
+        tcp_port=probe_tcp_port,
+        dns_cache=dns_cache
+    )
+    dns_cache.save()
+    return results
+
+def load_sync_state():
+    if not os.path.exists(sync_state_file):
+        return None
+    with open(sync_state_file, mode='r') as file:
+        return json.load(file)
+
+def save_sync_state(state):
+    tmp_file = f'{sync_state_file}.tmp'
+    with open(tmp_file, mode='w') as file:
+        json.dump(state, file)
+    os.replace(tmp_file, sync_state_file)
+
+def servicenow_datetime(value):
+    # '2024-08-29 13:45:00' -> javascript:gs.dateGenerate('2024-08-29','13:45:00')
+    date, _, time = value.partition(' ')
+    return f"javascript:gs.dateGenerate('{date}','{time or '00:00:00'}')"
+
+def build_snow_query(state=None, replay_from=None, replay_to=None):
+    """Encoded query for a full, incremental or replay run.
+
+    Incremental runs only filter on state here; records up to the saved
+    high-water mark are skipped by the keyset paging in process_snow_records.
+    """
+    if replay_from or replay_to:
+        query = "state=3"
+        if replay_from:
+            query += f"^sys_updated_on>={servicenow_datetime(replay_from)}"
+        if replay_to:
+            query += f"^sys_updated_on<={servicenow_datetime(replay_to)}"
+        return query
+    if state:
+        return "state=3"
+    return snow_query
+
+def process_snow_records(query=snow_query, state=None):
+    """Process matching records and return the new high-water mark, or None on failure.
+
+    The mark only moves up to the newest record before the oldest record
+    whose Zabbix lookup or write failed, so failed records are read again
+    next run.
+    """
     logging.info("INFO - Starting new run through ServiceNow records.\n")
+    high_water = (state['sys_updated_on'], state['sys_id']) if state else None
+    processed = []
+    failures = []
     
-    if response.status_code == 200:
-        data = response.json()
-
-        for record in data.get('result', []):
-            add_drop_modify = record.get('add_drop_modify')
-            u_adm_ip_addr = record.get('u_adm_ip_addr')
-            u_nn_adm_oldfqdn = record.get('u_nn_adm_oldfqdn')
-            # u_fqdn = record.get('u_fqdn')
-            u_nn_adm_newip = record.get('u_nn_adm_newip')
-            # u_nn_adm_newfqdn = record.get('u_nn_adm_newfqdn')
-            u_nn_adm_existingip = record.get('u_nn_adm_existingip')
-            u_nn_adm_zone = record.get('u_nn_adm_zone')
-            u_nn_adm_hostname = record.get('u_nn_adm_hostname')
-            u_nn_adm_newhostname = record.get('u_nn_adm_newhostname')
-
-            if u_nn_adm_hostname != '' and u_nn_adm_zone != '':
-                fqdn = u_nn_adm_hostname + u_nn_adm_zone
-            else:
-                logging.error(f'Hostname or domain name missing: u_nn_adm_hostname: {u_nn_adm_hostname} u_nn_adm_zone: {u_nn_adm_zone}')
-
-            if u_nn_adm_newhostname != '' and u_nn_adm_zone != '':
-                new_fqdn = u_nn_adm_newhostname + u_nn_adm_zone
-            else:
-                logging.error(f'New hostname or domain name missing: u_nn_adm_newhostname: {u_nn_adm_newhostname} u_nn_adm_zone: {u_nn_adm_zone}')
-
-            if add_drop_modify == '0':
-                action = 'ADD'
-            elif add_drop_modify == '2':
-                action = 'MODIFY'
-
-            logging.info(f"INFO - Processing record with ADM: {action}, DNS: {fqdn or new_fqdn}, IP: {u_adm_ip_addr or u_nn_adm_newip}")
-
-            if add_drop_modify == '2':
-                if fqdn != '' and new_fqdn != '' and u_nn_adm_existingip != '' and u_nn_adm_newip != '':
-                    search_params = {}
-                    search_params['ip'] = [u_nn_adm_existingip, u_nn_adm_newip]
-                    hosts = zabbix_host_get(search_params)
-
-                    nslresponse = os.system('nslookup ' + new_fqdn)
-
-                    if nslresponse == 0:
-                        logging.info(f"INFO - {new_fqdn} found")
-                    else:
-                        logging.error(f"ERROR - {new_fqdn} not found")
-                    
+    try:
+        # Keyset paging on (sys_updated_on, sys_id), so records updated
+        # during the read cannot shift others out of the result
+        records = list(snow.iter_records_after(
+            snow_table, query, 'sys_updated_on', after=high_water, fields=snow_fields, encode=servicenow_datetime
+        ))
+    except requests.exceptions.RequestException as e:
+        logging.error(f"ERROR - Failed to retrieve data from ServiceNow: {e}")
+        return None
 
-                    pingresponse = os.system("ping -c 1 " + u_nn_adm_newip)
+    logging.info(f"INFO - {len(records)} records changed since the last run.")
+    dns_results, reach_results = probe_records(records)
+
+    for record in records:
+        cursor = (record.get('sys_updated_on', ''), record.get('sys_id', ''))
+        try:
+                add_drop_modify = record.get('add_drop_modify')
+                u_adm_ip_addr = record.get('u_adm_ip_addr')
+                u_nn_adm_oldfqdn = record.get('u_nn_adm_oldfqdn')
+                # u_fqdn = record.get('u_fqdn')
+                u_nn_adm_newip = record.get('u_nn_adm_newip')
+                # u_nn_adm_newfqdn = record.get('u_nn_adm_newfqdn')
+                u_nn_adm_existingip = record.get('u_nn_adm_existingip')
+                u_nn_adm_zone = record.get('u_nn_adm_zone')
+                u_nn_adm_hostname = record.get('u_nn_adm_hostname')
+                u_nn_adm_newhostname = record.get('u_nn_adm_newhostname')
+
+                if u_nn_adm_hostname != '' and u_nn_adm_zone != '':
+                    fqdn = u_nn_adm_hostname + u_nn_adm_zone
+                else:
+                    logging.error(f'Hostname or domain name missing: u_nn_adm_hostname: {u_nn_adm_hostname} u_nn_adm_zone: {u_nn_adm_zone}')
 
-                    if pingresponse == 0:
-                        logging.info(f"INFO - {u_nn_adm_newip} pingable")
-                    else:
-                        logging.error(f"ERROR - {u_nn_adm_newip} not pingable")
+                if u_nn_adm_newhostname != '' and u_nn_adm_zone != '':
+                    new_fqdn = u_nn_adm_newhostname + u_nn_adm_zone
+                else:
+                    logging.error(f'New hostname or domain name missing: u_nn_adm_newhostname: {u_nn_adm_newhostname} u_nn_adm_zone: {u_nn_adm_zone}')
 
-                    if hosts:
-                        host_id = hosts[0]['hostid']
-                        current_dns = hosts[0]['interfaces'][0]['dns']
-                        current_ip = hosts[0]['interfaces'][0]['ip']
+                if add_drop_modify == '0':
+                    action = 'ADD'
+                elif add_drop_modify == '2':
+                    action = 'MODIFY'
 
-                        if current_dns != new_fqdn.strip() or current_ip != u_nn_adm_newip.strip():
-                            new_data = {
-                                "ip": u_nn_adm_newip,
-                                "dns": new_fqdn.strip()
-                            }
-                            zabbix_host_update(host_id, new_data)
-                            logging.info(f"INFO - Updated host {host_id} with new data: {new_data}")
-                        else:
-                            logging.info(f"INFO - No update needed for host {host_id}. DNS and IP are already up-to-date.")
-                    else:
-                        host_data = {
-                            "host": u_nn_adm_hostname,
-                            "interfaces": [{
-                                "type": 2,
-                                "main": 1,
-                                "useip": 0,
-                                "ip": u_nn_adm_newip,
-                                "dns": new_fqdn.strip(),
-                                "port": "161",
-                                "details": {
-                                    "version": '2',
-                                    "community" : "{$SNMP_COMMUNITY}"
-                                },
-                            }],
-                            "groups": [{"groupid": "257"}],
-                            "templates": [{"templateid": "10564"}],
-                            "inventory_mode": 1,
-                            "monitored_by": 1,
-                            "proxyid":  2
-                        }
-                        zabbix_host_create(host_data)
-                        logging.info(f"INFO - Host not found for {u_nn_adm_oldfqdn}, added new host: {host_data}")
+                logging.info(f"INFO - Processing record with ADM: {action}, DNS: {fqdn or new_fqdn}, IP: {u_adm_ip_addr or u_nn_adm_newip}")
 
-                else:
-                    logging.warning(f"ERROR - Record {record.get('sys_id')} with ADM=2 has incomplete FQDN data.")
+                if add_drop_modify == '2':
+                    if fqdn != '' and new_fqdn != '' and u_nn_adm_existingip != '' and u_nn_adm_newip != '':
+                        search_params = {}
+                        search_params['ip'] = [u_nn_adm_existingip, u_nn_adm_newip]
+                        hosts = find_hosts(search_params)
 
-            elif add_drop_modify == '0':
-                if fqdn != '' and u_adm_ip_addr != '':
-                    search_params = {}
-                    search_params['ip'] = u_adm_ip_addr
-                    search_params['dns'] = fqdn
+                        if dns_results.get(new_fqdn):
+                            logging.info(f"INFO - {new_fqdn} found")
+                        else:
+                            logging.error(f"ERROR - {new_fqdn} not found")
+                    
 
-                    nslresponse = os.system('nslookup ' + fqdn)
+                        if reach_results.get(u_nn_adm_newip):
+                            logging.info(f"INFO - {u_nn_adm_newip} pingable")
+                        else:
+                            logging.error(f"ERROR - {u_nn_adm_newip} not pingable")
+
+                        if hosts:
+                            host_id = hosts[0]['hostid']
+                            current_dns = hosts[0]['interfaces'][0]['dns']
+                            current_ip = hosts[0]['interfaces'][0]['ip']
+
+                            if current_dns != new_fqdn.strip() or current_ip != u_nn_adm_newip.strip():
+                                new_data = {
+                                    "ip": u_nn_adm_newip,
+                                    "dns": new_fqdn.strip()
+                                }
+                                if not write_update(cursor, hosts[0], new_data):
+                                    failures.append(cursor)
+                                logging.info(f"INFO - Updated host {host_id} with new data: {new_data}")
+                            else:
+                                logging.info(f"INFO - No update needed for host {host_id}. DNS and IP are already up-to-date.")
+                        else:
+                            host_data = {
+                                "host": u_nn_adm_hostname,
+                                "interfaces": [{
+                                    "type": 2,
+                                    "main": 1,
+                                    "useip": 0,
+                                    "ip": u_nn_adm_newip,
+                                    "dns": new_fqdn.strip(),
+                                    "port": "161",
+                                    "details": {
+                                        "version": '2',
+                                        "community" : "{$SNMP_COMMUNITY}"
+                                    },
+                                }],
+                                "groups": [{"groupid": "257"}],
+                                "templates": [{"templateid": "10564"}],
+                                "inventory_mode": 1,
+                                "monitored_by": 1,
+                                "proxyid":  2
+                            }
+                            if not write_create(cursor, host_data):
+                                failures.append(cursor)
+                            logging.info(f"INFO - Host not found for {u_nn_adm_oldfqdn}, added new host: {host_data}")
 
-                    if nslresponse == 0:
-                        logging.info(f"INFO - {fqdn} found")
                     else:
-                        logging.error(f"ERROR - {fqdn} not found")
-                    
+                        logging.warning(f"ERROR - Record {record.get('sys_id')} with ADM=2 has incomplete FQDN data.")
 
-                    pingresponse = os.system("ping -c 1 " + u_adm_ip_addr)
+                elif add_drop_modify == '0':
+                    if fqdn != '' and u_adm_ip_addr != '':
+                        search_params = {}
+                        search_params['ip'] = u_adm_ip_addr
+                        search_params['dns'] = fqdn
 
-                    if pingresponse == 0:
-                        logging.info(f"INFO - {u_adm_ip_addr} pingable")
-                    else:
-                        logging.error(f"ERROR - {u_adm_ip_addr} not pingable")
+                        if dns_results.get(fqdn):
+                            logging.info(f"INFO - {fqdn} found")
+                        else:
+                            logging.error(f"ERROR - {fqdn} not found")
+                    
+
+                        if reach_results.get(u_adm_ip_addr):
+                            logging.info(f"INFO - {u_adm_ip_addr} pingable")
+                        else:
+                            logging.error(f"ERROR - {u_adm_ip_addr} not pingable")
                     
-                    hosts = zabbix_host_get(search_params)
-                    if hosts:
-                        logging.info(f"INFO - Host already exists in Zabbix for IP: {u_adm_ip_addr}, FQDN: {fqdn}")
+                        hosts = find_hosts(search_params)
+                        if hosts:
+                            logging.info(f"INFO - Host already exists in Zabbix for IP: {u_adm_ip_addr}, FQDN: {fqdn}")
+                        else:
+                            host_data = {
+                                "host": u_nn_adm_hostname,
+                                "interfaces": [{
+                                    "type": 2,
+                                    "main": 1,
+                                    "useip": 0,
+                                    "ip": u_adm_ip_addr,
+                                    "dns": fqdn.strip(),
+                                    "port": "161",
+                                    "details": {
+                                        "version": '2',
+                                        "community" : "{$SNMP_COMMUNITY}"
+                                    },
+                                }],
+                                "groups": [{"groupid": "257"}],
+                                "templates": [{"templateid": "10564"}],
+                                "inventory_mode": 1,
+                                "monitored_by": 1,
+                                "proxyid":  2
+                            }
+                            if not write_create(cursor, host_data):
+                                failures.append(cursor)
+                            logging.info(f"INFO - Added new host with data: {host_data}")
                     else:
-                        host_data = {
-                            "host": u_nn_adm_hostname,
-                            "interfaces": [{
-                                "type": 2,
-                                "main": 1,
-                                "useip": 0,
-                                "ip": u_adm_ip_addr,
-                                "dns": fqdn.strip(),
-                                "port": "161",
-                                "details": {
-                                    "version": '2',
-                                    "community" : "{$SNMP_COMMUNITY}"
-                                },
-                            }],
-                            "groups": [{"groupid": "257"}],
-                            "templates": [{"templateid": "10564"}],
-                            "inventory_mode": 1,
-                            "monitored_by": 1,
-                            "proxyid":  2
-                        }
-                        zabbix_host_create(host_data)
-                        logging.info(f"INFO - Added new host with data: {host_data}")
-                else:
-                    logging.warning(f"ERROR - Record {record.get('sys_id')} with ADM=0 has incomplete IP or FQDN data.")
+                        logging.warning(f"ERROR - Record {record.get('sys_id')} with ADM=0 has incomplete IP or FQDN data.")
 
-            logging.info("\n")  # Space out each record in the log
+        except requests.exceptions.RequestException as e:
+            # A failed Zabbix call only affects this record, which is read
+            # again next run
+            logging.error(f"ERROR - Zabbix request failed for record {record.get('sys_id')}: {e}")
+            failures.append(cursor)
 
-    else:
-        logging.error(f"ERROR - Failed to retrieve data from ServiceNow: {response.status_code}, {response.text}")
+        logging.info("\n")  # Space out each record in the log
+        processed.append(cursor)
+
+    failures.extend(apply_pending_writes())
 
     logging.info("INFO - Finished processing ServiceNow records.\n")
+    if failures:
+        oldest_failure = min(failures)
+        logging.warning(f"WARNING - {len(failures)} records failed in Zabbix; records from {oldest_failure[0]} on will be read again next run.")
+        processed = [cursor for cursor in processed if cursor < oldest_failure]
+    if not processed:
+        return state
+    newest = max(processed)
+    return {'sys_updated_on': newest[0], 'sys_id': newest[1]}
+
+parser = argparse.ArgumentParser(description="Apply ServiceNow add/drop/modify records to Zabbix.")
+parser.add_argument('--full', action='store_true', help='Ignore the saved high-water mark and re-read the last 7 days.')
+parser.add_argument('--replay-from', help="Reprocess records updated at or after this time ('YYYY-MM-DD HH:MM:SS').")
+parser.add_argument('--replay-to', help="Reprocess records updated at or before this time ('YYYY-MM-DD HH:MM:SS').")
+parser.add_argument('--snapshot', action='store_true', help='Load all host interfaces once and answer lookups from memory.')
+parser.add_argument('--workers', type=int, default=write_workers, help='Zabbix host create/update calls to run in parallel.')
+parser.add_argument('--rate', type=float, default=write_rate, help='Max Zabbix create/update calls per second.')
+args = parser.parse_args()
+
+write_workers = args.workers
+write_rate = args.rate
+if write_workers > 1:
+    pending_hosts = HostIndex()
+
+if args.snapshot:
+    host_index = HostIndex.load(zabbix)
 
 # Execute the processing function
-process_snow_records()
+if args.replay_from or args.replay_to:
+    # Replays never move the high-water mark
+    process_snow_records(build_snow_query(replay_from=args.replay_from, replay_to=args.replay_to))
+else:
+    sync_state = None if args.full else load_sync_state()
+    new_state = process_snow_records(build_snow_query(sync_state), sync_state)
+    if new_state and new_state != sync_state:
+        previous = load_sync_state()
+        if not previous or (new_state['sys_updated_on'], new_state['sys_id']) > (previous['sys_updated_on'], previous['sys_id']):
+            save_sync_state(new_state)
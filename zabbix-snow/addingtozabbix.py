@@ -2,151 +2,292 @@
 # Aug 29, 2024
 
 import csv
-import requests 
+import json
+import os
+import threading
+import workers
+from zabbix_client import ZabbixClient
 ZABBIX_API_URL = 'https://zabbix.example.net/api_jsonrpc.php' # 
 
-headers = {
-    'Content-Type': 'application/json-rpc'
-}
-
 auth_token = '' # 
 
+WORKERS = 8        # Parallel host imports
+RATE_LIMIT = 20    # Max host imports started per second, None for no limit
+GROUP_CACHE_FILE = None  # e.g. 'groupids.json' to keep group name -> id between runs
+JOURNAL_FILE = 'import-journal.jsonl'  # Per-host outcomes, lets a rerun resume
+BULK_IMPORT = False  # Submit host.create in JSON-RPC batches instead of the worker pool
+CHUNK_SIZE = 100     # host.create calls per batch in bulk mode
+
+zabbix = ZabbixClient(ZABBIX_API_URL, auth_token, pool_size=WORKERS, timeout=1800)
+
+
 # -------------------------------------------
 
+class GroupResolver:
+    """Host group name -> groupid lookups for a whole import run.
 
-def zabbix_api_request(data):
-    response = requests.post(ZABBIX_API_URL, headers=headers, json=data, timeout=1800)
-    response.raise_for_status()
-    return response.json()
+    prefetch() resolves every referenced group name with one hostgroup.get
+    and creates the missing groups in a single batch, so rows never need
+    their own group round trip.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.groupids = {}
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, mode='r') as file:
+                self.groupids = json.load(file)
+
+    def prefetch(self, group_names):
+        wanted = {name for name in group_names if name and name != 'undefined'}
+        unknown = sorted(wanted - self.groupids.keys())
+        if not unknown:
+            return
+
+        result = zabbix.call("hostgroup.get", {
+            "output": ["groupid", "name"],
+            "filter": {
+                "name": unknown
+            }
+        })
+        if not result or 'result' not in result:
+            raise Exception(f"Failed to get group information for {unknown}")
+        for group in result['result']:
+            self.groupids[group['name']] = group['groupid']
+
+        # Group not found, create all missing groups in one batch
+        missing = [name for name in unknown if name not in self.groupids]
+        if missing:
+            results = zabbix.call_many([("hostgroup.create", {"name": name}) for name in missing])
+            for name, result in zip(missing, results):
+                if 'result' not in result:
+                    raise Exception(f"Failed to create group {name}: {result.get('error')}")
+                self.groupids[name] = result['result']['groupids'][0]
+                print(f"Created host group {name}")
+
+        self.save()
+
+    def get(self, group_name):
+        return self.groupids.get(group_name)
+
+    def save(self):
+        if self.cache_file:
+            with open(self.cache_file, mode='w') as file:
+                json.dump(self.groupids, file)
 
 
 # -------------------------------------------
 
-def get_groupid(hosts_group_name):
-    if hosts_group_name != '' or hosts_group_name != 'undefined':
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "hostgroup.get",
-            "params": {
-                "output": "extend",
-                "filter": {
-                    "name": [
-                        hosts_group_name
-                    ]
-                }
-            },
-            "auth": auth_token,
-            "id": 1
-        }
-        result = zabbix_api_request(payload)
-        if result and 'result' in result:
-            if len(result['result']) > 0:
-                return result['result'][0]['groupid']  # Return existing group ID
-            else:
-                # Group not found, create a new group
-                return create_host_group(hosts_group_name)
-        else:
-            raise Exception(f"Failed to get group information for {hosts_group_name}")
-    else:
-        raise Exception(f"Group name undefined or none")
+
+class ImportJournal:
+    """Append-only record of each host's import outcome.
+
+    Every outcome (created, skipped or failed) is written as one JSON line
+    as soon as it is known. On a rerun, hosts whose latest outcome is
+    created or skipped are left alone and only failures are retried.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.outcomes = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, mode='rb') as file:
+            lines = file.readlines()
+        valid_size = 0
+        for number, line in enumerate(lines, start=1):
+            try:
+                entry = json.loads(line) if line.strip() else None
+            except ValueError:
+                # Only the last line can be half written by a crash
+                if number < len(lines):
+                    raise
+                print(f"Ignoring incomplete last line of {self.path}: {line!r}")
+                with open(self.path, mode='r+b') as file:
+                    file.truncate(valid_size)
+                break
+            valid_size += len(line)
+            if entry:
+                self.outcomes[entry['host']] = entry['outcome']
+
+    def done(self, host_name):
+        return self.outcomes.get(host_name) in ('created', 'skipped')
+
+    def record(self, host_name, outcome, hostid=None, error=None):
+        entry = {"host": host_name, "outcome": outcome, "hostid": hostid, "error": error}
+        with self._lock:
+            self.outcomes[host_name] = outcome
+            with open(self.path, mode='a') as file:
+                file.write(json.dumps(entry) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
 
 # -------------------------------------------
 
 
-def create_host_group(hosts_group_name):
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "hostgroup.create",
-        "params": {
-            "name": hosts_group_name
-        },
-        "auth": auth_token,
-        "id": 1
+def build_host_params(row, groupid):
+    tags = []
+    if row['hosts_tag_name'].strip() and row['hosts_tag_value'].strip():
+        tags.append({
+            "tag": row['hosts_tag_name'].strip(),
+            "value": row['hosts_tag_value'].strip()
+        })
+
+    return {
+        "host": row['hosts_host'].strip(),
+        "status": 1,
+        "interfaces": [
+            {
+                "type": 2,
+                "main": 1,
+                "useip": int(row['hosts_interfaces_useip']),
+                "ip": row['hosts_interfaces_ip'].strip(),
+                "dns": row['hosts_interfaces_dns'].strip(),
+                "port": "161",
+                "details": {
+                    "version": int(row['hosts_interface_details_version']),
+                    "community": "{$SNMP_COMMUNITY}" if row['hosts_interface_details_community'].strip() == "N0An3T" else row['hosts_interface_details_community'].strip()
+                }
+            }
+        ],
+        "groups": [
+            {
+                "groupid": groupid
+            }
+        ],
+        "templates": [
+            {
+                "templateid": "10564"
+            }
+        ],
+        "tags": tags,
+        "inventory_mode": 1,
+        "monitored_by": 1,
+        "proxyid": 2 if row['hosts_proxy_name'].strip() == "olympia-proxy" else 1
     }
-    result = zabbix_api_request(payload)
-    print(result)
-    if result and 'result' in result:
-        return result['result']['groupids'][0]  # Return the newly created group ID
-    else:
-        raise Exception(f"Failed to create group {hosts_group_name}")
+
+
+# -------------------------------------------
+
+
+def import_host(row, groupid):
+    host_exists = check_host_exists(row['hosts_host'].strip())
+    if host_exists:
+        print(f"Host {row['hosts_host'].strip()} already exists, skipping creation.")
+        return None
+
+    # Send the request to create the host
+    result = zabbix.call("host.create", build_host_params(row, groupid))
+    if 'error' in result:
+        raise Exception(f"Failed to create host {row['hosts_host'].strip()}: {result['error']}")
+    print(f"Host {row['hosts_host'].strip()} created successfully")
+    return result['result']['hostids'][0]
+
+
+def journaled_import(journal, row, groupid):
+    host_name = row['hosts_host'].strip()
+    try:
+        hostid = import_host(row, groupid)
+    except Exception as e:
+        journal.record(host_name, 'failed', error=str(e))
+        raise
+    journal.record(host_name, 'created' if hostid else 'skipped', hostid=hostid)
+    return hostid
+
+
+def bulk_import(journal, pending):
+    """Create hosts with one existence lookup and chunked host.create batches.
+
+    pending holds (line_number, row, groupid) tuples. Each batch result is
+    mapped back to its CSV line and written to the journal.
+    """
+    existing = zabbix.existing_host_names(row['hosts_host'].strip() for _, row, _ in pending)
+    created = failed = 0
+
+    to_create = []
+    for line_number, row, groupid in pending:
+        host_name = row['hosts_host'].strip()
+        if host_name in existing:
+            print(f"Host {host_name} already exists, skipping creation.")
+            journal.record(host_name, 'skipped')
+        else:
+            to_create.append((line_number, row, groupid))
+
+    for start in range(0, len(to_create), CHUNK_SIZE):
+        chunk = to_create[start:start + CHUNK_SIZE]
+        results = zabbix.call_many(
+            [("host.create", build_host_params(row, groupid)) for _, row, groupid in chunk],
+            max_batch_size=CHUNK_SIZE
+        )
+        for (line_number, row, _), result in zip(chunk, results):
+            host_name = row['hosts_host'].strip()
+            if 'error' in result:
+                print(f"Line {line_number}: failed to create host {host_name}: {result['error']}")
+                journal.record(host_name, 'failed', error=str(result['error']))
+                failed += 1
+            else:
+                hostid = result['result']['hostids'][0]
+                journal.record(host_name, 'created', hostid=hostid)
+                created += 1
+        print(f"Submitted {min(start + CHUNK_SIZE, len(to_create))}/{len(to_create)} new hosts")
+
+    print(f"Bulk import: {created} created, {len(pending) - len(to_create)} skipped, {failed} failed.")
 
 
 # -------------------------------------------
 
 
 def main():
+    tasks = []
+    rows = []
+    journal = ImportJournal(JOURNAL_FILE)
+
     with open('missing-hosts.csv', mode='r') as csv_file:
         print('file opened')
         csv_reader = csv.DictReader(csv_file)
 
-        for _ in range(201):
-            next(csv_reader)
-
         for row in csv_reader:
             if row['import'].strip() == '0':
                 print(f"Skipping import for host {row['hosts_host'].strip()} as per CSV directive.")
                 continue
-            
-            # Retrieve the group ID
-            groupid = get_groupid(row['hosts_group_name'].strip())
-            if not groupid:
-                print(f"Failed to find groupid for {row['hosts_group_name'].strip()}")
+            if journal.done(row['hosts_host'].strip()):
                 continue
+            rows.append((csv_reader.line_num, row))
 
-            host_exists = check_host_exists(row['hosts_host'].strip())
-            if host_exists:
-                print(f"Host {row['hosts_host'].strip()} already exists, skipping creation.")
-                continue
-                
-            tags = []
-            if row['hosts_tag_name'].strip() and row['hosts_tag_value'].strip():
-                tags.append({
-                    "tag": row['hosts_tag_name'].strip(),
-                    "value": row['hosts_tag_value'].strip()
-                })
-
-            payload = {
-                "jsonrpc": "2.0",
-                "method": "host.create",
-                "params": {
-                    "host": row['hosts_host'].strip(),
-                    "status": 1,
-                    "interfaces": [
-                        {
-                            "type": 2,
-                            "main": 1,
-                            "useip": int(row['hosts_interfaces_useip']),
-                            "ip": row['hosts_interfaces_ip'].strip(),
-                            "dns": row['hosts_interfaces_dns'].strip(),
-                            "port": "161",
-                            "details": {
-                                "version": int(row['hosts_interface_details_version']),
-                                "community": "{$SNMP_COMMUNITY}" if row['hosts_interface_details_community'].strip() == "N0An3T" else row['hosts_interface_details_community'].strip()
-                            }
-                        }
-                    ],
-                    "groups": [
-                        {
-                            "groupid": groupid
-                        }
-                    ],
-                    "templates": [
-                        {
-                            "templateid": "10564"
-                        }
-                    ],
-                    "tags": tags,
-                    "inventory_mode": 1,
-                    "monitored_by": 1,
-                    "proxyid": 2 if row['hosts_proxy_name'].strip() == "olympia-proxy" else 1
-                },
-                "auth": auth_token,
-                "id": 1
-            }
+    print(f"{len(rows)} hosts left to import, {len(journal.outcomes)} already in {JOURNAL_FILE}")
+
+    # Resolve (and create) every group referenced by the import up front
+    groups = GroupResolver(GROUP_CACHE_FILE)
+    groups.prefetch(row['hosts_group_name'].strip() for _, row in rows)
+
+    pending = []
+    for line_number, row in rows:
+        # Retrieve the group ID
+        groupid = groups.get(row['hosts_group_name'].strip())
+        host_name = row['hosts_host'].strip()
+        if not groupid:
+            print(f"Failed to find groupid for {row['hosts_group_name'].strip()}")
+            journal.record(host_name, 'failed', error=f"No group {row['hosts_group_name'].strip()}")
+            continue
 
-            # Send the request to create the host
-            result = zabbix_api_request(payload)
-            print(f"Host {row['hosts_host'].strip()} created successfully")
+        pending.append((line_number, row, groupid))
+
+    if BULK_IMPORT:
+        bulk_import(journal, pending)
+        return
+
+    for _, row, groupid in pending:
+        host_name = row['hosts_host'].strip()
+        tasks.append((host_name, f"Import of host {host_name}", journaled_import, (journal, row, groupid)))
+
+    # Rows for the same host stay in CSV order, different hosts run in parallel
+    results = workers.run_keyed(tasks, workers=WORKERS, rate=RATE_LIMIT)
+    succeeded, failed = workers.summarize(results)
+    print(f"Processed {len(results)} hosts with {WORKERS} workers: {succeeded} succeeded, {failed} failed.")
 
 
 
@@ -155,19 +296,12 @@ def main():
 
 
 def check_host_exists(host_name):
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "host.get",
-        "params": {
-            "output": ["host"],
-            "filter": {
-                "host": [host_name]
-            }
-        },
-        "auth": auth_token,
-        "id": 1
-    }
-    result = zabbix_api_request(payload)
+    result = zabbix.call("host.get", {
+        "output": ["host"],
+        "filter": {
+            "host": [host_name]
+        }
+    })
     if result and 'result' in result:
         return len(result['result']) > 0
     return False
@@ -2,127 +2,176 @@
 # Aug 29, 2024
 
 import requests
+import argparse
+import csv
+import ipaddress
 import json
+import re
+import workers
+from itertools import chain
+from snow_client import ServiceNowClient
+from zabbix_client import ZabbixClient
 
 zabbix_url = 'https://zabbix.example.net/api_jsonrpc.php'
 #zabbix_auth_token = '' #dev
 zabbix_auth_token = '' #prod
 
-servicenow_url = 'https://example.service-now.com/api/now/table/cmdb_ci_netgear'
+servicenow_instance = 'https://example.service-now.com'
 servicenow_user = ''
 servicenow_password = ''
 
-def fetch_all_hosts(zabbix_url, auth_token):
-    all_hosts = []
-    offset = 0
-    limit = 10000 
-
-
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "host.get",
-        "params": {
-            "selectInterfaces": "extend",
-            "selectTags": "extend",
-            "selectHostGroups": "extend"
-        },
-        "auth": auth_token,
-        "id": 1
+target_groupids = ['209']  # Host groups whose hosts get CID tags
+
+def fetch_all_hosts(zabbix, limit=10000, groupids=None, output=None):
+    # Generator: yields one page of at most `limit` hosts at a time.
+    # Zabbix filters by group and returns only the requested host fields
+    # plus interface IPs and tags.
+    params = {
+        "output": output or ["hostid"],
+        "selectInterfaces": ["ip", "main"],
+        "selectTags": ["tag", "value"]
     }
+    if groupids:
+        params["groupids"] = groupids
 
     try:
-        response = requests.post(zabbix_url, json=payload)
-        response.raise_for_status()  # Raise HTTPError for bad responses
-        data = response.json()
-        hosts = data.get('result', [])
+        for hosts in zabbix.iter_host_pages(params, page_size=limit):  # Raises HTTPError for bad responses
+            yield hosts
 
-        all_hosts.extend(hosts)
+    # Checked first: requests' JSONDecodeError is also a RequestException
+    except json.decoder.JSONDecodeError as e:
+        print(f"Failed to parse JSON response from Zabbix: {e}")
+        print(f"Raw response content: {e.doc}")  # Print raw content for debugging
+        return  # Stop paging on failure
 
     except requests.exceptions.RequestException as e:
         print(f"Request to Zabbix failed: {e}")
-        return []  # Return an empty list on failure
+        return  # Stop paging on failure
 
-    except json.decoder.JSONDecodeError as e:
-        print(f"Failed to parse JSON response from Zabbix: {e}")
-        print(f"Raw response content: {response.text}")  # Print raw content for debugging
-        return []  # Return an empty list on failure
-
-    return all_hosts
-
-
-hosts_info = fetch_all_hosts(zabbix_url, zabbix_auth_token)
-
-servicenow_params = {
-            'operational_status': '1',
-            'sysparm_fields': 'u_cpe_dns,u_mgmt_ip_address,u_sid,u_customer,operational_status',
-            'device_type': 'cpe',
-        }
-servicenow_response = requests.get(servicenow_url, params=servicenow_params, auth=(servicenow_user, servicenow_password))
-servicenow_data = servicenow_response.json()
-servicenow_result = servicenow_data.get('result', [])
-
-def filter_by_ip(data, search_ip):
-    return [record for record in data if search_ip in record.get('u_mgmt_ip_address', '')]
-
-for host in hosts_info:
-    print(host)
-    host_id = host.get('hostid')
-    ip = None
-    groupids = []
-
-    if host.get('interfaces'):
-        ip = host['interfaces'][0].get('ip')
-
-    if host.get('hostgroups'):
-        groupids = [group.get('groupid') for group in host['hostgroups']]
-        #print(groupids)
-
-    tags = host.get('tags', [])
-    tag_dict = {tag['tag']: tag['value'] for tag in tags}
-
-    if ip and ip != '127.0.0.1':
-        if "209" in groupids:
-            if servicenow_result:
-                servicenow_filtered_results = filter_by_ip(servicenow_result, ip)
-                
-                if servicenow_filtered_results:
-                    u_sid = servicenow_filtered_results[0].get('u_sid')
-                    print(tag_dict)
-
-                    if 'CID' in tag_dict:
-                        if tag_dict['CID'] == u_sid:
-                            print('CID already exists, skipping')
-                        else:
-                            print('CID already exists, but different than found one')
-                            print('Existing CID:', tag_dict['CID'])
-                            print('New CID:', u_sid)
-                    else:
-                        # Handle case where 'CID' does not exist in tag_dict
-                        tag_dict['CID'] = u_sid
-                        print('CID does not exist in tag_dict')
-
-                        zabbix_update_payload = {
-                            "jsonrpc": "2.0",
-                            "method": "host.update",
-                            "params": {
-                                "hostid": host_id,
-                                "tags": [{"tag": tag, "value": value} for tag, value in tag_dict.items()]
-                            },
-                            "auth": zabbix_auth_token,
-                            "id": 1
-                        }
-
-                        # Uncomment to perform the API call
-                        update_response = requests.post(zabbix_url, json=zabbix_update_payload)
-                        update_data = update_response.json()
-                        print(f'Updated host {host_id} new tags: {[{"tag": tag, "value": value} for tag, value in tag_dict.items()]}')
 
+parser = argparse.ArgumentParser(description="Add ServiceNow CID tags to Zabbix hosts.")
+parser.add_argument('--dry-run', metavar='PATH', help='Write the planned tag changes to PATH (.json or .csv) instead of applying them.')
+parser.add_argument('--apply-mode', choices=['batch', 'workers'], default='batch', help='Send updates as JSON-RPC batches or through a worker pool.')
+parser.add_argument('--batch-size', type=int, default=100, help='host.update calls per batch.')
+parser.add_argument('--workers', type=int, default=8, help='Parallel host.update calls in workers mode.')
+args = parser.parse_args()
+
+zabbix = ZabbixClient(zabbix_url, zabbix_auth_token, pool_size=args.workers)
+hosts_info = chain.from_iterable(fetch_all_hosts(zabbix, groupids=target_groupids))
+
+servicenow = ServiceNowClient(servicenow_instance, auth=(servicenow_user, servicenow_password))
+servicenow_result = list(servicenow.iter_records(
+    'cmdb_ci_netgear',
+    'operational_status=1^device_type=cpe',
+    fields=['u_cpe_dns', 'u_mgmt_ip_address', 'u_sid', 'u_customer', 'operational_status']
+))
+
+def normalize_ip(value):
+    # '10.0.0.1/30 ' -> '10.0.0.1'
+    value = value.strip().split('/')[0]
+    try:
+        return str(ipaddress.ip_address(value))
+    except ValueError:
+        return value
+
+def build_ip_index(data):
+    # Exact management IP -> CMDB records, built once per run
+    ip_index = {}
+    for record in data:
+        for value in re.split(r'[,;\s]+', record.get('u_mgmt_ip_address') or ''):
+            if value:
+                ip_index.setdefault(normalize_ip(value), []).append(record)
+    return ip_index
+
+def filter_by_ip(ip_index, search_ip):
+    return ip_index.get(normalize_ip(search_ip), [])
+
+servicenow_ip_index = build_ip_index(servicenow_result)
+
+def plan_tag_updates(hosts_info, ip_index):
+    # Phase 1: work out which tags each host is missing, without changing anything
+    plan = []
+    for host in hosts_info:
+        host_id = host.get('hostid')
+        ip = None
+
+        for interface in host.get('interfaces', []):
+            if interface.get('main') == '1':
+                ip = interface.get('ip')
+                break
+
+        tags = host.get('tags', [])
+        tag_dict = {tag['tag']: tag['value'] for tag in tags}
+
+        if ip and ip != '127.0.0.1':
+            servicenow_filtered_results = filter_by_ip(ip_index, ip)
+
+            if servicenow_filtered_results:
+                u_sid = servicenow_filtered_results[0].get('u_sid')
+
+                if 'CID' in tag_dict:
+                    if tag_dict['CID'] != u_sid:
+                        print(f'Host {host_id}: CID already exists, but different than found one '
+                              f'(existing {tag_dict["CID"]}, new {u_sid})')
                 else:
-                    print('Couldnt find IP')
-            #else:
-                #print(f'No u_sid found for IP {ip}')
-        #else:
-            #print(f'No matching records found in ServiceNow for IP {ip}')
-    #else:
-        #if ip != '127.0.0.1':
-            #print(f'No IP found for host {host_id}')
+                    plan.append({
+                        "hostid": host_id,
+                        "ip": ip,
+                        "tags_to_add": [{"tag": "CID", "value": u_sid}],
+                        "existing_tags": tags
+                    })
+            else:
+                print(f'Couldnt find IP {ip} for host {host_id}')
+    return plan
+
+def write_plan(plan, path):
+    # Dry run output: JSON for *.json paths, CSV otherwise
+    with open(path, mode='w', newline='') as file:
+        if path.endswith('.json'):
+            json.dump(plan, file, indent=2)
+        else:
+            writer = csv.writer(file)
+            writer.writerow(['hostid', 'ip', 'tag', 'value'])
+            for entry in plan:
+                for tag in entry['tags_to_add']:
+                    writer.writerow([entry['hostid'], entry['ip'], tag['tag'], tag['value']])
+    print(f'Wrote plan for {len(plan)} hosts to {path}')
+
+def update_params(entry):
+    # host.update replaces the whole tag list, so existing tags are resent
+    return {
+        "hostid": entry['hostid'],
+        "tags": [{"tag": tag['tag'], "value": tag['value']} for tag in entry['existing_tags'] + entry['tags_to_add']]
+    }
+
+def apply_plan(plan, mode='batch', batch_size=100, worker_count=8):
+    # Phase 2: send the planned host.update calls as JSON-RPC batches or
+    # through a bounded worker pool
+    if mode == 'workers':
+        def update_host(entry):
+            result = zabbix.call("host.update", update_params(entry))
+            if 'error' in result:
+                raise Exception(result['error'])
+            return result['result']
+
+        tasks = [(entry['hostid'], f"Update of host {entry['hostid']}", update_host, (entry,)) for entry in plan]
+        results = workers.run_keyed(tasks, workers=worker_count)
+        succeeded, failed = workers.summarize(results)
+    else:
+        results = zabbix.call_many([("host.update", update_params(entry)) for entry in plan], max_batch_size=batch_size)
+        failed = 0
+        for entry, result in zip(plan, results):
+            if 'error' in result:
+                print(f"Failed to update host {entry['hostid']}: {result['error']}")
+                failed += 1
+        succeeded = len(plan) - failed
+    print(f'Tagged {succeeded} hosts, {failed} failed.')
+
+
+plan = plan_tag_updates(hosts_info, servicenow_ip_index)
+print(f'{len(plan)} hosts need new tags')
+
+if args.dry_run:
+    write_plan(plan, args.dry_run)
+else:
+    apply_plan(plan, mode=args.apply_mode, batch_size=args.batch_size, worker_count=args.workers)
@@ -0,0 +1,92 @@
+# Persistent DNS answer cache shared by add-modify.py and host-generator/script.py.
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import dns.resolver  # dnspython, optional: gives real record TTLs
+except ImportError:
+    dns = None
+
+
+class DNSCache:
+    """Name -> addresses cache with per-entry expiry, saved to a JSON file.
+
+    Answers are kept for their record TTL when dnspython is installed and
+    for default_ttl seconds otherwise. Names that do not resolve are cached
+    as negative answers for negative_ttl seconds. Expired entries are
+    dropped when the file is loaded and saved.
+    """
+
+    def __init__(self, path='dns_cache.json', default_ttl=300, negative_ttl=60):
+        self.path = path
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, mode='r') as file:
+                entries = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable DNS cache {self.path}: {e}')
+            return
+        now = time.time()
+        self._entries = {name: entry for name, entry in entries.items() if entry['expires'] > now}
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            entries = {name: entry for name, entry in self._entries.items() if entry['expires'] > now}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, mode='w') as file:
+            json.dump(entries, file)
+        os.replace(tmp_path, self.path)
+
+    def get(self, name):
+        """Return cached addresses ([] for a negative answer), or None if not fresh."""
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None or entry['expires'] <= time.time():
+            return None
+        return entry['addresses']
+
+    def put(self, name, addresses, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl if addresses else self.negative_ttl
+        with self._lock:
+            self._entries[name] = {'addresses': list(addresses), 'expires': time.time() + ttl}
+
+    def resolve(self, name):
+        """Return the addresses of name, from the cache while the answer is fresh."""
+        addresses = self.get(name)
+        if addresses is not None:
+            return addresses
+
+        addresses, ttl = _query(name)
+        self.put(name, addresses, ttl)
+        return addresses
+
+
+def _query(name):
+    if dns is not None:
+        try:
+            answer = dns.resolver.resolve(name, 'A')
+            return sorted(record.address for record in answer), answer.rrset.ttl
+        except dns.exception.DNSException:
+            return [], None
+    try:
+        infos = socket.getaddrinfo(name, None, type=socket.SOCK_STREAM)
+    except OSError:
+        return [], None
+    return sorted({info[4][0] for info in infos}), None
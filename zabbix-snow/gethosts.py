@@ -1,72 +1,63 @@
 # Max Gadeberg
 # Aug 29, 2024
 
+import argparse
 import csv
+import gzip
 import logging
+import os
 import requests
+from zabbix_client import ZabbixClient
 
 zabbix_url = 'https://zabbix.example.net/api_jsonrpc.php'
 zabbix_auth_token = ''  # Make sure to fill this in
 
-def get_zabbix_hosts():
+zabbix = ZabbixClient(zabbix_url, zabbix_auth_token)
+page_size = 1000
+item_chunk_size = 500  # hostids per item.get in exact-key mode
+
+def iter_zabbix_hosts(page_size=page_size):
+    """Yield pages of hosts instead of loading the whole inventory at once.
+
+    Errors are logged and re-raised, so a failure part way through does not
+    look like the end of the host list.
+    """
     try:
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "host.get",
-            "params": {
-                "output": ["hostid", "name", "host", "status"],
-                "selectInterfaces": ["ip", "dns", "main", "type", "useip"],
-                "selectTags": "extend",
-                "selectInventory": ["tag", "value"],
-            },
-            "auth": zabbix_auth_token,
-            "id": 1
-        }
-        response = requests.post(zabbix_url, json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        hosts = data.get('result', [])
-        print(f"Retrieved {len(hosts)} hosts.")
-        return hosts
+        total = 0
+        for hosts in zabbix.iter_host_pages({
+            "output": ["hostid", "name", "host", "status"],
+            "selectInterfaces": ["ip", "dns", "main", "type", "useip"],
+            "selectTags": "extend",
+            "selectInventory": ["tag", "value"],
+        }, page_size=page_size):
+            total += len(hosts)
+            yield hosts
+        print(f"Retrieved {total} hosts.")
     except requests.exceptions.RequestException as e:
         logging.error(f'Error fetching Zabbix hosts: {e}')
-        return []
+        raise
     except Exception as e:
-        logging.error(f'Unexpected error in get_zabbix_hosts: {e}')
-        return []
+        logging.error(f'Unexpected error in iter_zabbix_hosts: {e}')
+        raise
 
-def get_items_for_hosts(item_keys):
+def get_items_for_hosts(item_keys, hostids=None):
     try:
-        print('|'.join(item_keys))
-        print(item_keys)
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "item.get",
-            "params": {
-                "output": ["hostid", "itemid", "lastvalue", "key_"],
-                "selectHosts": True,
-                "searchWildcardsEnabled": True,
-                "search": {
-                    "key_": item_keys
-                },
-                "searchByAny": "true",
-                "sortfield": "itemid",
-                "sortorder": "DESC"
+        params = {
+            "output": ["hostid", "itemid", "lastvalue", "key_"],
+            "selectHosts": True,
+            "searchWildcardsEnabled": True,
+            "search": {
+                "key_": item_keys
             },
-            "auth": zabbix_auth_token,
-            "id": 1
+            "searchByAny": "true",
+            "sortfield": "itemid",
+            "sortorder": "DESC"
         }
-        response = requests.post(zabbix_url, json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
+        if hostids is not None:
+            params["hostids"] = hostids
+        data = zabbix.call("item.get", params)
         items = data.get('result', [])
-        print(f"Retrieved {len(items)} items.")
+        logging.debug(f"Retrieved {len(items)} items.")
         return items
     except requests.exceptions.RequestException as e:
         logging.error(f'Error fetching Zabbix item data: {e}')
@@ -75,6 +66,41 @@ def get_items_for_hosts(item_keys):
         logging.error(f'Unexpected error in get_items_for_hosts: {e}')
         return []
 
+def get_items_by_exact_key(item_keys, hostids=None, chunk_size=item_chunk_size):
+    """Fetch items with filter.key_ instead of a wildcard search.
+
+    An exact filter lets Zabbix use the item key index instead of a LIKE
+    scan, and only the fields the report needs are returned. hostids are
+    split into chunks sent together as one JSON-RPC batch.
+    """
+    try:
+        params = {
+            "output": ["hostid", "key_", "lastvalue"],
+            "filter": {
+                "key_": item_keys
+            }
+        }
+        if hostids is None:
+            calls = [("item.get", params)]
+        else:
+            calls = [("item.get", dict(params, hostids=hostids[start:start + chunk_size]))
+                     for start in range(0, len(hostids), chunk_size)]
+
+        items = []
+        for data in zabbix.call_many(calls):
+            if 'error' in data:
+                logging.error(f"Zabbix API returned an error fetching items: {data['error']}")
+                continue
+            items.extend(data['result'])
+        logging.debug(f"Retrieved {len(items)} items.")
+        return items
+    except requests.exceptions.RequestException as e:
+        logging.error(f'Error fetching Zabbix item data: {e}')
+        return []
+    except Exception as e:
+        logging.error(f'Unexpected error in get_items_by_exact_key: {e}')
+        return []
+
 def load_item_keys(filename='items.csv'):
     item_keys = []
     try:
@@ -90,47 +116,82 @@ def load_item_keys(filename='items.csv'):
         logging.error(f'Error reading item keys from {filename}: {e}')
         return []
 
-def save_hosts_to_csv(hosts, items, item_keys, filename='zabbix_hosts.csv'):
-    # Create a dictionary for quick lookup of item data by hostid and key
-    items_by_hostid = {}
-    for item in items:
-        host_id = item['hostid']
-        key = item['key_']
-        if host_id not in items_by_hostid:
-            items_by_hostid[host_id] = {}
-        items_by_hostid[host_id][key] = item['lastvalue']
-
-    with open(filename, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        # Write the header row with dynamic item keys as columns
-        header = ["IP", "Host Name", "DNS", "Enabled/Disabled", "SNMP Availability"] + item_keys
-        writer.writerow(header)
-        
-        for host in hosts:
-            ip = dns = snmp_availability = None
-            for interface in host.get('interfaces', []):
-                if interface['main'] == '1':
-                    ip = interface['ip'] if interface['useip'] == '1' else None
-                    dns = interface['dns'] if interface['useip'] == '0' else None
-                    # Type '2' generally indicates SNMP interface in Zabbix
-                    snmp_availability = 'Available' if interface['type'] == '2' else 'Not Available'
-                    break
-            
-            host_name = host.get('host', '')
-            status = 'Enabled' if host.get('status') == '0' else 'Disabled'
-            
-            # Retrieve the last values for each item key
-            row = [ip, host_name, dns, status, snmp_availability]
-            for key in item_keys:
-                row.append(items_by_hostid.get(host['hostid'], {}).get(key, 'N/A'))
-            
-            print(f"Writing row: {row}")
-            writer.writerow(row)
+def iter_host_item_windows(host_pages, item_keys, exact_keys=False):
+    """Join each page of hosts with the items of just those hostids."""
+    get_items = get_items_by_exact_key if exact_keys else get_items_for_hosts
+    for hosts in host_pages:
+        items = get_items(item_keys, hostids=[host['hostid'] for host in hosts])
+
+        # Create a dictionary for quick lookup of item data by hostid and key
+        items_by_hostid = {}
+        for item in items:
+            host_id = item['hostid']
+            key = item['key_']
+            if host_id not in items_by_hostid:
+                items_by_hostid[host_id] = {}
+            items_by_hostid[host_id][key] = item['lastvalue']
+
+        yield hosts, items_by_hostid
+
+def host_row(host, host_items, item_keys):
+    ip = dns = snmp_availability = None
+    for interface in host.get('interfaces', []):
+        if interface['main'] == '1':
+            ip = interface['ip'] if interface['useip'] == '1' else None
+            dns = interface['dns'] if interface['useip'] == '0' else None
+            # Type '2' generally indicates SNMP interface in Zabbix
+            snmp_availability = 'Available' if interface['type'] == '2' else 'Not Available'
+            break
+    
+    host_name = host.get('host', '')
+    status = 'Enabled' if host.get('status') == '0' else 'Disabled'
+    
+    # Retrieve the last values for each item key
+    row = [ip, host_name, dns, status, snmp_availability]
+    for key in item_keys:
+        row.append(host_items.get(key, 'N/A'))
+    return row
+
+def save_hosts_to_csv(windows, item_keys, filename='zabbix_hosts.csv', compress=False, buffer_size=1024 * 1024):
+    """Write report rows window by window, gzip-compressed if compress is set.
+
+    The report is written to a temporary file and only moved to filename
+    once every window has been written, so a failed run leaves no
+    truncated report behind.
+    """
+    tmp_filename = f'{filename}.tmp'
+    if compress:
+        file = gzip.open(tmp_filename, mode='wt', newline='')
+    else:
+        file = open(tmp_filename, mode='w', newline='', buffering=buffer_size)
+
+    rows_written = 0
+    try:
+        with file:
+            writer = csv.writer(file)
+            # Write the header row with dynamic item keys as columns
+            header = ["IP", "Host Name", "DNS", "Enabled/Disabled", "SNMP Availability"] + item_keys
+            writer.writerow(header)
+
+            for hosts, items_by_hostid in windows:
+                writer.writerows(host_row(host, items_by_hostid.get(host['hostid'], {}), item_keys) for host in hosts)
+                rows_written += len(hosts)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+    print(f"Wrote {rows_written} hosts to {filename}.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a CSV report of Zabbix hosts and item values.")
+    parser.add_argument('--output', default='zabbix_hosts.csv', help='Path of the CSV report to write.')
+    parser.add_argument('--gzip', action='store_true', help='Gzip-compress the report.')
+    parser.add_argument('--page-size', type=int, default=page_size, help='Hosts fetched and written per window.')
+    parser.add_argument('--exact-keys', action='store_true', help='Match item keys exactly instead of by wildcard search.')
+    args = parser.parse_args()
+
     item_keys = load_item_keys('items.csv')  # Load item keys from items.csv
-    hosts = get_zabbix_hosts()
-    if hosts and item_keys:
-        items = get_items_for_hosts(item_keys)
-        if items:
-            save_hosts_to_csv(hosts, items, item_keys)
+    if item_keys:
+        windows = iter_host_item_windows(iter_zabbix_hosts(args.page_size), item_keys, exact_keys=args.exact_keys)
+        save_hosts_to_csv(windows, item_keys, filename=args.output, compress=args.gzip)
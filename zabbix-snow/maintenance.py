@@ -5,26 +5,36 @@ import requests
 import logging
 from collections import defaultdict
 from datetime import datetime
+from snow_client import ServiceNowClient
+from zabbix_client import ZabbixClient
 
-servicenow_url = "https://example.service-now.com/api/now/table/u_change_service?sysparm_query=chg_start_date%3Ejavascript%3Ags.endOfToday()&sysparm_fields=chg_number%2Cbs_name%2Cbs_u_cpe_dns%2Cchg_start_date%2Cchg_end_date&sysparm_limit=1000"
+servicenow_instance = "https://example.service-now.com"
+servicenow_table = "u_change_service"
+servicenow_query = "chg_start_date>javascript:gs.endOfToday()"
+servicenow_fields = ["chg_number", "bs_name", "bs_u_cpe_dns", "chg_start_date", "chg_end_date"]
 zabbix_url = 'https://zabbix.example.net/api_jsonrpc.php'
 zabbix_auth_token = ''
 
+zabbix = ZabbixClient(zabbix_url, zabbix_auth_token)
+servicenow = ServiceNowClient(servicenow_instance, headers={
+    'Authorization': '',
+    'Cookie': ''
+})
+
+# How hosts are resolved for the circuits of a change order batch:
+# 'all' pulls every host with its tags and matches a circuit against the
+# value of any tag, 'tags' asks Zabbix only for hosts whose circuit_tag
+# value is one of the circuits (Zabbix tag filters need a tag name), so
+# hosts carrying the circuit under another tag are not matched
+host_resolution = 'all'
+circuit_tag = 'CID'
+circuit_chunk_size = 200
 
 
 def get_servicenow_change_orders():
     
     try:
-        payload = {}
-        headers = {
-            'Authorization': '',
-            'Cookie': ''
-        }
-        response = requests.request("GET", servicenow_url, headers=headers, data=payload)
-        response.raise_for_status()
-        data = response.json()
-        
-        mydata = data.get('result',[])
+        mydata = servicenow.iter_records(servicenow_table, servicenow_query, fields=servicenow_fields)
         change_orders = defaultdict(list)
         
         for orders in mydata:
@@ -48,21 +58,9 @@ def get_servicenow_change_orders():
 
 def get_zabbix_hosts():
     try:
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "host.get",
-            "params": {
-                "selectTags": "extend",
-            },
-            "auth": zabbix_auth_token,
-            "id": 1
-        }
-        response = requests.post(zabbix_url, json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
+        data = zabbix.call("host.get", {
+            "selectTags": "extend",
+        })
         hosts = data.get('result', [])
         return hosts
     except requests.exceptions.RequestException as e:
@@ -75,91 +73,149 @@ def get_zabbix_hosts():
 
 
 
-def find_matching_hosts(circuits, hosts):
-    matching_hosts = []
+def get_zabbix_hosts_for_circuits(circuits):
+    # Returns None if any chunk fails: a partial host list would make the
+    # reconciler shrink live maintenances
+    try:
+        circuits = sorted(set(circuits))
+        calls = []
+        for start in range(0, len(circuits), circuit_chunk_size):
+            calls.append(("host.get", {
+                "output": ["hostid"],
+                "selectTags": ["tag", "value"],
+                "evaltype": 2,  # Or
+                "tags": [
+                    {"tag": circuit_tag, "value": circuit, "operator": 1}  # Equals
+                    for circuit in circuits[start:start + circuit_chunk_size]
+                ]
+            }))
+
+        wanted = set(circuits)
+        hosts = {}
+        for data in zabbix.call_many(calls):
+            if 'error' in data:
+                logging.error(f"Zabbix API returned an error fetching hosts by tag: {data['error']}")
+                return None
+            for host in data['result']:
+                # Keep only the tags that matched, the rest is not needed
+                host['tags'] = [tag for tag in host['tags'] if tag['tag'] == circuit_tag and tag['value'] in wanted]
+                hosts[host['hostid']] = host
+        return list(hosts.values())
+    except requests.exceptions.RequestException as e:
+        logging.error(f'Error fetching Zabbix hosts by tag: {e}')
+        return None
+    except Exception as e:
+        logging.error(f'Unexpected error in get_zabbix_hosts_for_circuits: {e}')
+        return None
+
+
+
+
+def build_tag_index(hosts):
+    # Map each tag value to the hosts carrying it, built once per run
+    tag_index = defaultdict(list)
     for host in hosts:
         for tag in host.get('tags', []):
             tag_value = tag.get('value')
-            if tag_value in circuits:
-                matching_hosts.append({
-                    'hostid': host.get('hostid'),
-                    'tag': tag.get('tag'),
-                    'value': tag_value
-                })
-                logging.info(f'Found matching host for circuit {tag_value}')
+            tag_index[tag_value].append({
+                'hostid': host.get('hostid'),
+                'tag': tag.get('tag'),
+                'value': tag_value
+            })
+    return tag_index
+
+
+
+
+def find_matching_hosts(circuits, tag_index):
+    matching_hosts = []
+    for circuit in set(circuits):
+        for match in tag_index.get(circuit, []):
+            matching_hosts.append(match)
+            logging.info(f'Found matching host for circuit {circuit}')
     return matching_hosts
 
 
 
 
-def get_maintenance_in_zabbix(chg_number):
+def to_unix_time(time_str):
+    return int(datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S").timestamp())
+
+
+
+
+def get_maintenances_in_zabbix(chg_numbers):
+    # One maintenance.get for every change order in the run, keyed by name
     try:
-        headers = {
-            'Content-Type': 'application/json-rpc'
-        }
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "maintenance.get",
-            "params": {
-                "filter": {
-                    "name": chg_number
-                },
-                "output": "extend"
+        data = zabbix.call("maintenance.get", {
+            "filter": {
+                "name": list(chg_numbers)
             },
-            "auth": zabbix_auth_token,
-            "id": 1
-        }
-        response = requests.post(zabbix_url, json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        # print(data)
-        maintenances = data.get('result', [])
-        # print(f"Maintenaces: {maintenances}")
-        return maintenances
+            "output": ["maintenanceid", "name", "active_since", "active_till"],
+            "selectHosts": ["hostid"]
+        })
+        if 'error' in data:
+            logging.error(f"Zabbix API returned an error fetching maintenances: {data['error']}")
+            return None
+        return {maintenance['name']: maintenance for maintenance in data.get('result', [])}
     except requests.exceptions.RequestException as e:
-        logging.error(f'Error fetching maintenance from Zabbix: {e}')
-        return []
+        logging.error(f'Error fetching maintenances from Zabbix: {e}')
+        return None
     except Exception as e:
-        logging.error(f'Unexpected error in get_maintenance_in_zabbix: {e}')
-        return []
+        logging.error(f'Unexpected error in get_maintenances_in_zabbix: {e}')
+        return None
 
 
 
 
-def create_maintenance_in_zabbix(chg_order, start_time, end_time, hostid):
-    try:
-        hosts_formatted = [{'hostid': int(hostid)} for hostid in hostid]
-        print(f"Hosts formatted: {hosts_formatted}")
+def build_desired_maintenances(change_orders, tag_index):
+    # chg_number -> hostids and window. A change order listed with several
+    # windows gets one maintenance spanning all of them.
+    desired = {}
+    for (chg_number, start_time, end_time), circuits in change_orders.items():
+        logging.info(f"Processing change order {chg_number} from {start_time} to {end_time}")
+
+        matching_hosts = find_matching_hosts(circuits, tag_index)
+        logging.info(f"Found {len(matching_hosts)} matching hosts")
+        if not matching_hosts:
+            logging.warning(f'No matching hosts found in Zabbix for circuits {circuits}.')
+            continue
 
-        print(start_time)
+        start_unix = to_unix_time(start_time)
+        end_unix = to_unix_time(end_time)
+        maintenance = desired.setdefault(chg_number, {
+            'hostids': set(),
+            'active_since': start_unix,
+            'active_till': end_unix
+        })
+        maintenance['hostids'].update(item['hostid'] for item in matching_hosts)
+        maintenance['active_since'] = min(maintenance['active_since'], start_unix)
+        maintenance['active_till'] = max(maintenance['active_till'], end_unix)
+    return desired
 
-        dt_start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
-        dt_end_time = datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S")
 
-        print(dt_start_time)
 
-        # Convert to Unix time
-        start_unix = int(dt_start_time.timestamp())
-        end_unix = int(dt_end_time.timestamp())
 
-        print(type(start_unix))
+def plan_maintenance_changes(desired, actual):
+    # Returns the maintenance.create and maintenance.update calls needed to
+    # bring Zabbix to the desired state, skipping maintenances already in it
+    creates = []
+    updates = []
+    for chg_number, maintenance in desired.items():
+        hosts_formatted = [{'hostid': int(hostid)} for hostid in sorted(maintenance['hostids'], key=int)]
+        existing = actual.get(chg_number)
 
-        headers = {
-            'Content-Type': 'application/json-rpc'
-        }
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "maintenance.create",
-            "params": {
-                "name": f"{chg_order}",
-                "active_since": start_unix,
-                "active_till": end_unix,
+        if existing is None:
+            creates.append((chg_number, {
+                "name": chg_number,
+                "active_since": maintenance['active_since'],
+                "active_till": maintenance['active_till'],
                 "tags_evaltype": 0,
                 "hosts": hosts_formatted,
                 "tags": [
                     {
                         "tag": "change order",
-                        "value": chg_order
+                        "value": chg_number
                     }
                 ],
                 "timeperiods": [
@@ -167,69 +223,38 @@ def create_maintenance_in_zabbix(chg_order, start_time, end_time, hostid):
                         "timeperiod_type": 0
                     }
                 ]
-            },
-            "auth": zabbix_auth_token,
-            "id": 1
-        }
-
-        print(payload)
-
-        response = requests.post(zabbix_url, json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        print(data)
-        maintenance_id = data.get('result', {}).get('maintenanceids', [])[0]
-        return maintenance_id
-    except requests.exceptions.RequestException as e:
-        logging.error(f'Error creating maintenance in Zabbix: {e}')
-        return None
-    except Exception as e:
-        logging.error(f'Unexpected error in create_maintenance_in_zabbix: {e}')
-        return None
-
+            }))
+            continue
 
+        existing_hostids = {host['hostid'] for host in existing.get('hosts', [])}
+        if (existing_hostids == maintenance['hostids']
+                and int(existing['active_since']) == maintenance['active_since']
+                and int(existing['active_till']) == maintenance['active_till']):
+            logging.info(f'Maintenance for {chg_number} is already up to date.')
+            continue
 
+        updates.append((chg_number, {
+            "maintenanceid": existing['maintenanceid'],
+            "hosts": hosts_formatted,
+            "active_since": maintenance['active_since'],
+            "active_till": maintenance['active_till']
+        }))
+    return creates, updates
 
-def update_maintenance_in_zabbix(maintenance_id, start_time, end_time, hostid):
-    try:
-        
-        hosts_formatted = [{'hostid': int(hostid)} for hostid in hostid]
 
-        dt_start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
-        dt_end_time = datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S")
 
-        print(dt_start_time)
 
-        # Convert to Unix time
-        start_unix = int(dt_start_time.timestamp())
-        end_unix = int(dt_end_time.timestamp())
+def apply_maintenance_changes(creates, updates):
+    calls = [("maintenance.create", params) for _, params in creates]
+    calls += [("maintenance.update", params) for _, params in updates]
+    verbs = ['create'] * len(creates) + ['update'] * len(updates)
+    chg_numbers = [chg_number for chg_number, _ in creates + updates]
 
-        headers = {
-            'Content-Type': 'application/json-rpc'
-        }
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "maintenance.update", 
-            "params": {
-                "hosts": hosts_formatted,
-                "maintenanceid": maintenance_id,
-                "active_since": start_unix,
-                "active_till": end_unix
-            },
-            "auth": zabbix_auth_token,
-            "id": 1
-        }
-        response = requests.post(zabbix_url, json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        print(f'Data: {data}')
-        return True
-    except requests.exceptions.RequestException as e:
-        logging.error(f'Error updating maintenance in Zabbix: {e}')
-        return False
-    except Exception as e:
-        logging.error(f'Unexpected error in update_maintenance_in_zabbix: {e}')
-        return False
+    for chg_number, verb, data in zip(chg_numbers, verbs, zabbix.call_many(calls)):
+        if 'error' in data:
+            logging.error(f"Failed to {verb} maintenance in Zabbix for {chg_number}: {data['error']}")
+        else:
+            logging.info(f'{verb.capitalize()}d maintenance in Zabbix for {chg_number}.')
 
 
 
@@ -256,45 +281,30 @@ def main():
         change_orders = get_servicenow_change_orders()
         logging.info(f'Fetched {len(change_orders)} change orders from ServiceNow.')
 
-        hosts = get_zabbix_hosts()
-        logging.info(f'Fetched {len(hosts)} hosts from Zabbix.')
-
-        for (chg_number, start_time, end_time), circuits in change_orders.items():
-            logging.info(f"Processing change order {chg_number} from {start_time} to {end_time}")
-
-            matching_hosts = find_matching_hosts(circuits, hosts)
-            logging.info(f"Found {len(matching_hosts)} matching hosts")
-
-            print(matching_hosts)
-
-            for circuit in circuits:
-                logging.info(f"Processing circuit: {circuit}")
-
-                if matching_hosts:
-                    hostid_list = [item['hostid'] for item in matching_hosts]
-
-                    logging.info(f"Matching hosts IDS: {hostid_list}")
-                    zabbix_maintenances = get_maintenance_in_zabbix(chg_number)
-                    logging.info(f"Zabbix maintenances: {zabbix_maintenances}")
-
-                    if zabbix_maintenances:
-                        maintenance_id = zabbix_maintenances[0]['maintenanceid']
-                        update_success = update_maintenance_in_zabbix(maintenance_id, start_time, end_time, hostid_list)
-                        # update_success = True
-                        if update_success:
-                            logging.info(f'Updated maintenance in Zabbix for circuit {circuit}.')
-                        else:
-                            logging.error(f'Failed to update maintenance in Zabbix for circuit {circuit}.')
-                    else:
-                        maintenance_id = create_maintenance_in_zabbix(chg_number, start_time, end_time, hostid_list)
-                        # maintenance_id = True
-                        if maintenance_id:
-                            logging.info(f'Created maintenance in Zabbix for circuit {circuit}.')
-                        else:
-                            logging.error(f'Failed to create maintenance in Zabbix for circuit {circuit}.')
-                else:
-                    logging.warning(f'No matching hosts found in Zabbix for circuit {circuit}.')
-            
+        if host_resolution == 'tags':
+            hosts = get_zabbix_hosts_for_circuits(
+                circuit for circuits in change_orders.values() for circuit in circuits)
+        else:
+            hosts = get_zabbix_hosts()
+
+        if hosts is None:
+            logging.error('Could not resolve the hosts of the change orders, nothing was changed.')
+        else:
+            logging.info(f'Fetched {len(hosts)} hosts from Zabbix.')
+
+            tag_index = build_tag_index(hosts)
+
+            desired = build_desired_maintenances(change_orders, tag_index)
+
+            actual = get_maintenances_in_zabbix(desired.keys())
+            if actual is None:
+                logging.error('Could not fetch existing maintenances, nothing was changed.')
+            else:
+                creates, updates = plan_maintenance_changes(desired, actual)
+                logging.info(f'{len(creates)} maintenances to create, {len(updates)} to update, '
+                             f'{len(desired) - len(creates) - len(updates)} unchanged.')
+                apply_maintenance_changes(creates, updates)
+
     except Exception as e:
         logging.error(f'Unexpected error in main: {e}')
 
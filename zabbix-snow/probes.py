@@ -0,0 +1,84 @@
+# Concurrent DNS and reachability probes used by add-modify.py.
+
+import asyncio
+import socket
+
+
+async def resolve(name, timeout, dns_cache=None):
+    """Return True if name resolves to at least one address.
+
+    With a dnscache.DNSCache, fresh cached answers are used as-is and new
+    answers are stored in it.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        if dns_cache is not None:
+            addresses = await asyncio.wait_for(loop.run_in_executor(None, dns_cache.resolve, name), timeout)
+        else:
+            addresses = await asyncio.wait_for(loop.getaddrinfo(name, None, type=socket.SOCK_STREAM), timeout)
+        return bool(addresses)
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+
+async def ping(ip, timeout):
+    """Return True if ip answers a single ICMP echo."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ping', '-c', '1', '-W', str(int(max(timeout, 1))), ip,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+    except OSError:
+        return False
+    try:
+        return await asyncio.wait_for(process.wait(), timeout + 1) == 0
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return False
+
+
+async def tcp_connect(ip, port, timeout):
+    """Return True if a TCP connection to ip:port can be opened."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def _probe_all(names, ips, concurrency, timeout, method, tcp_port, dns_cache):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(probe, *args):
+        async with semaphore:
+            return await probe(*args)
+
+    names = list(dict.fromkeys(names))
+    ips = list(dict.fromkeys(ips))
+    if method == 'tcp':
+        reach_probes = [bounded(tcp_connect, ip, tcp_port, timeout) for ip in ips]
+    else:
+        reach_probes = [bounded(ping, ip, timeout) for ip in ips]
+
+    results = await asyncio.gather(
+        *(bounded(resolve, name, timeout, dns_cache) for name in names),
+        *reach_probes
+    )
+    return dict(zip(names, results[:len(names)])), dict(zip(ips, results[len(names):]))
+
+
+def run_probes(names, ips, concurrency=50, timeout=2, method='icmp', tcp_port=22, dns_cache=None):
+    """Resolve names and check ips concurrently.
+
+    Returns two dicts, name -> resolved and ip -> reachable. At most
+    concurrency probes run at once and each is bounded by timeout seconds.
+    method is 'icmp' (one ping) or 'tcp' (connect to tcp_port).
+    """
+    return asyncio.run(_probe_all(names, ips, concurrency, timeout, method, tcp_port, dns_cache))
@@ -0,0 +1,97 @@
+# Shared ServiceNow Table API reader used by the zabbix-snow scripts.
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ServiceNowClient:
+    """Pooled reader for the ServiceNow Table API.
+
+    iter_records() pages through a table with sysparm_offset/sysparm_limit
+    and yields records one at a time, so tables larger than a single page
+    are read completely without holding every page in memory.
+    """
+
+    def __init__(self, instance_url, auth=None, headers=None, pool_size=4, timeout=120):
+        self.instance_url = instance_url.rstrip('/')
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.auth = auth
+        self.session.headers.update({'Accept': 'application/json'})
+        if headers:
+            self.session.headers.update(headers)
+
+    def iter_records(self, table, query='', fields=None, page_size=1000, max_pages=None):
+        """Yield every record of table matching the encoded query.
+
+        max_pages stops after that many pages, for callers doing their own paging.
+        """
+        # Offset paging needs a stable order between pages
+        if 'ORDERBY' not in query:
+            query = f'{query}^ORDERBYsys_id' if query else 'ORDERBYsys_id'
+
+        params = {
+            'sysparm_query': query,
+            'sysparm_limit': page_size,
+            'sysparm_exclude_reference_link': 'true',
+            'sysparm_no_count': 'true'
+        }
+        if fields:
+            params['sysparm_fields'] = ','.join(fields)
+
+        offset = 0
+        pages = 0
+        while True:
+            params['sysparm_offset'] = offset
+            response = self.session.get(f'{self.instance_url}/api/now/table/{table}', params=params, timeout=self.timeout)
+            response.raise_for_status()
+            records = response.json().get('result', [])
+            yield from records
+
+            pages += 1
+            if len(records) < page_size or pages == max_pages:
+                break
+            offset += page_size
+
+    def iter_records_after(self, table, query, key_field, after=None, fields=None, page_size=1000, encode=str):
+        """Yield records of table ordered by (key_field, sys_id), starting after the pair after.
+
+        Each page asks for rows past the last (key_field, sys_id) returned
+        instead of using an offset, so rows that change while the table is
+        being read cannot shift others past a page boundary. encode turns a
+        key_field value into its encoded query form.
+        """
+        if fields:
+            fields = list(dict.fromkeys([*fields, key_field, 'sys_id']))
+        prefix = f'{query}^' if query else ''
+        order = f'^ORDERBY{key_field}^ORDERBYsys_id'
+
+        while True:
+            if after:
+                value, sys_id = encode(after[0]), after[1]
+                # (key > value) OR (key = value AND sys_id > last sys_id)
+                page_query = (f'{prefix}{key_field}>{value}^NQ'
+                              f'{prefix}{key_field}={value}^sys_id>{sys_id}{order}')
+            else:
+                page_query = f'{prefix}{order[1:]}'
+
+            records = list(self.iter_records(table, page_query, fields=fields, page_size=page_size, max_pages=1))
+            start = after
+            for record in records:
+                cursor = (record.get(key_field, ''), record.get('sys_id', ''))
+                if after and cursor <= tuple(after):
+                    continue
+                yield record
+                after = cursor
+
+            # A short page is the last one; a page that did not move the
+            # cursor would only be fetched again
+            if len(records) < page_size or after == start:
+                break
+
+    def close(self):
+        self.session.close()
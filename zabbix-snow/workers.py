@@ -0,0 +1,70 @@
+# Bounded, rate-limited worker pool for Zabbix write calls.
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` calls per second, with bursts up to `burst`."""
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+def run_keyed(tasks, workers=8, rate=None):
+    """Run (key, description, fn, args) tasks on a thread pool.
+
+    Tasks sharing a key run one after another in the order given, so e.g.
+    a host.create is always sent before a later host.update of the same
+    host; different keys run in parallel on up to `workers` threads. At
+    most `rate` calls per second are started across all workers.
+
+    Returns one result dict per task, in task order, with 'key',
+    'description', 'ok' and either 'result' or 'error'.
+    """
+    limiter = RateLimiter(rate)
+    results = [None] * len(tasks)
+
+    queues = {}
+    for position, task in enumerate(tasks):
+        queues.setdefault(task[0], []).append((position, task))
+
+    def run_queue(queue):
+        for position, (key, description, fn, args) in queue:
+            limiter.wait()
+            try:
+                results[position] = {'key': key, 'description': description, 'ok': True, 'result': fn(*args)}
+            except Exception as e:
+                logging.error(f'{description} failed: {e}')
+                results[position] = {'key': key, 'description': description, 'ok': False, 'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(run_queue, queue) for queue in queues.values()]:
+            future.result()
+    return results
+
+
+def summarize(results):
+    """Return (succeeded, failed) counts for run_keyed results."""
+    succeeded = sum(1 for result in results if result['ok'])
+    return succeeded, len(results) - succeeded
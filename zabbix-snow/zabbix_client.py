@@ -0,0 +1,130 @@
+# Shared Zabbix JSON-RPC client used by the zabbix-snow scripts.
+
+import itertools
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ZabbixClient:
+    """Keep-alive JSON-RPC client for api_jsonrpc.php.
+
+    A single requests.Session is reused for every call so the TCP and TLS
+    handshake is only paid once per pooled connection instead of once per
+    request. call_many() sends several calls per POST as JSON-RPC batches.
+    """
+
+    def __init__(self, url, auth_token, pool_size=10, timeout=300, max_batch_size=100):
+        self.url = url
+        self.auth_token = auth_token
+        self.timeout = timeout
+        self.max_batch_size = max_batch_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json-rpc'})
+
+        self._ids = itertools.count(1)
+        self._id_lock = threading.Lock()
+
+    def next_id(self):
+        """Return the next request id, unique for the lifetime of the client."""
+        with self._id_lock:
+            return next(self._ids)
+
+    def build_payload(self, method, params):
+        return {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "auth": self.auth_token,
+            "id": self.next_id()
+        }
+
+    def post(self, payload, timeout=None):
+        """POST an already built payload and return the decoded JSON response."""
+        response = self.session.post(self.url, json=payload, timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def call(self, method, params, timeout=None):
+        """Call a single API method and return the full JSON-RPC response."""
+        return self.post(self.build_payload(method, params), timeout=timeout)
+
+    def call_many(self, calls, max_batch_size=None, timeout=None):
+        """Send (method, params) pairs as JSON-RPC batch arrays.
+
+        Responses are matched back to their calls by id and returned in call
+        order. A call Zabbix rejects keeps its own 'error' entry, so one bad
+        call does not fail the rest of its batch.
+        """
+        max_batch_size = max_batch_size or self.max_batch_size
+        responses = []
+        for start in range(0, len(calls), max_batch_size):
+            payloads = [self.build_payload(method, params) for method, params in calls[start:start + max_batch_size]]
+            data = self.post(payloads, timeout=timeout)
+
+            # A malformed batch is answered with a single error object
+            if isinstance(data, dict):
+                data = [data]
+            by_id = {response.get('id'): response for response in data}
+            missing = by_id.get(None, {"error": {"code": -32603, "message": "No response returned for request."}})
+            for payload in payloads:
+                responses.append(by_id.get(payload['id'], missing))
+        return responses
+
+    def existing_host_names(self, host_names, chunk_size=1000):
+        """Return the subset of host_names that already exist in Zabbix.
+
+        Names are sent as large filter.host arrays, several chunks per batch,
+        so the number of round trips scales with chunks rather than names.
+        """
+        host_names = list(dict.fromkeys(host_names))
+        calls = [
+            ("host.get", {"output": ["host"], "filter": {"host": host_names[start:start + chunk_size]}})
+            for start in range(0, len(host_names), chunk_size)
+        ]
+        existing = set()
+        for response in self.call_many(calls):
+            if 'error' in response:
+                raise Exception(f"host.get failed: {response['error']}")
+            existing.update(host['host'] for host in response['result'])
+        return existing
+
+    def all_host_names(self, page_size=1000):
+        """Return a snapshot of every technical host name in Zabbix.
+
+        Names are read page by page through iter_host_pages(), so no single
+        host.get has to return every host.
+        """
+        names = set()
+        for hosts in self.iter_host_pages({"output": ["host"]}, page_size=page_size):
+            names.update(host['host'] for host in hosts)
+        return names
+
+    def iter_host_pages(self, params, page_size=1000):
+        """Yield host.get results one page of at most page_size hosts at a time.
+
+        host.get has no offset or range filter, so the matching hostids are
+        fetched first (ids only, no select* output) and then requested in
+        ascending hostid windows with the full params. Only one page of full
+        host objects is held in memory at a time.
+        """
+        id_params = {key: value for key, value in params.items() if not key.startswith('select')}
+        id_params.update({"output": ["hostid"], "sortfield": "hostid"})
+        response = self.call("host.get", id_params)
+        if 'error' in response:
+            raise Exception(f"host.get failed: {response['error']}")
+        hostids = sorted(int(host['hostid']) for host in response['result'])
+
+        for start in range(0, len(hostids), page_size):
+            page_params = dict(params, hostids=hostids[start:start + page_size], sortfield="hostid")
+            response = self.call("host.get", page_params)
+            if 'error' in response:
+                raise Exception(f"host.get failed: {response['error']}")
+            yield response['result']
+
+    def close(self):
+        self.session.close()